@@ -1,6 +1,5 @@
 import subprocess
 from dataclasses_json import dataclass_json
-import jsonpickle
 import enum
 from collections import OrderedDict
 import inspect
@@ -53,6 +52,7 @@ class LibraryDiff():
 
     
 def load_api(library: str, filename: str):
+    import jsonpickle # slow to import, and only needed here
     with open(os.path.join(os.path.dirname(__file__), f"../../libraries/{library}/api/", filename), 'r') as jsonfile:
         api = jsonpickle.decode(jsonfile.read())
     return api
@@ -0,0 +1,66 @@
+import argparse
+import time
+import numpy as np
+from upgraider.EmbeddingIndex import EmbeddingIndex, IVFIndex
+
+def random_index(num_sections: int, dim: int, num_topics: int, seed: int = 0) -> EmbeddingIndex:
+    """
+    Synthetic corpus of normalized embeddings grouped around num_topics topics, like release notes of many libraries
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(num_topics, dim))
+    vectors = topics[rng.integers(num_topics, size=num_sections)] + rng.normal(scale=1.0, size=(num_sections, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return EmbeddingIndex(np.arange(num_sections), vectors.astype(np.float32))
+
+def database_index() -> EmbeddingIndex:
+    from upgraider.Database import get_embedded_doc_sections, load_embeddings
+    return EmbeddingIndex.from_embeddings(load_embeddings(get_embedded_doc_sections()))
+
+def time_searches(index: EmbeddingIndex, queries: np.ndarray, k: int) -> (list, float):
+    """
+    Results of all queries and the mean latency in milliseconds
+    """
+    start = time.perf_counter()
+    results = [index.search(query, k=k) for query in queries]
+    return results, (time.perf_counter() - start) / len(queries) * 1000
+
+def recall(results: list, exact_results: list) -> float:
+    found = [len({id for _, id in approx} & {id for _, id in exact}) / max(len(exact), 1) for approx, exact in zip(results, exact_results)]
+    return float(np.mean(found))
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare recall and latency of the ivf index to the exact index')
+    parser.add_argument('--db', action='store_true', help='use the embeddings of the release notes database instead of a synthetic corpus')
+    parser.add_argument('--sections', type=int, help='number of synthetic sections', default=200000)
+    parser.add_argument('--dim', type=int, help='dimension of the synthetic embeddings', default=1536)
+    parser.add_argument('--topics', type=int, help='number of topics of the synthetic sections', default=300)
+    parser.add_argument('--queries', type=int, help='number of queries', default=100)
+    parser.add_argument('--k', type=int, help='number of results per query', default=20)
+    parser.add_argument('--lists', type=int, help='number of clusters (default: square root of the number of sections)', default=None)
+    parser.add_argument('--nprobe', type=int, nargs='+', help='numbers of clusters scanned per query to compare', default=[1, 4, 8, 16, 32])
+
+    args = parser.parse_args()
+
+    index = database_index() if args.db else random_index(args.sections, args.dim, args.topics)
+    rng = np.random.default_rng(1)
+    # queries are perturbed sections, as snippets resemble the notes that describe their APIs
+    queries = index.matrix[rng.integers(len(index), size=args.queries)]
+    queries = queries + rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+
+    start = time.perf_counter()
+    ivf_index = IVFIndex.build(index, num_lists=args.lists)
+    print(f"Built ivf index of {ivf_index.num_lists} lists over {len(index)} sections in {time.perf_counter() - start:.1f}s")
+
+    exact_results, exact_latency = time_searches(index, queries, args.k)
+
+    print(f"| Index | nprobe | Recall@{args.k} | Latency (ms) |")
+    print(f"| --- | --: | --: | --: |")
+    print(f"| exact | -- | 1.000 | {exact_latency:.2f} |")
+    for nprobe in args.nprobe:
+        ivf_index.nprobe = nprobe
+        results, latency = time_searches(ivf_index, queries, args.k)
+        print(f"| ivf | {nprobe} | {recall(results, exact_results):.3f} | {latency:.2f} |")
+
+if __name__ == "__main__":
+    main()
@@ -96,6 +96,26 @@ def display_report(title, reports: dict):
        
         print(f"| {lib} | {num_snippets} | {num_apis} | {doc_display} | ")
 
+def display_metrics(title, reports: dict):
+    """
+    Where time (seconds) and tokens go, per library and source. Runs time both the original and the modified snippet.
+    """
+    print(f"# {title}")
+    print(f"| Library | Source | Wall (s) | Model (s) | Runs (s) | Embedding (s) | Retrieval (s) | Prompt Tokens | Completion Tokens |")
+    print(f"| --- | --- | --: | --: | --: | --: | --: | --: | --: |")
+
+    for lib, report in reports.items():
+        for source, source_report in report.items():
+            metrics = source_report.metrics
+            if not metrics: # reports written before metrics were recorded
+                continue
+
+            timings = metrics.get('timings', {})
+            counters = metrics.get('counters', {})
+            run_time = timings.get('run_original', 0) + timings.get('run_modified', 0)
+
+            print(f"| {lib} | {source} | {timings.get('wall', 0):.1f} | {timings.get('model_call', 0):.1f} | {run_time:.1f} | {timings.get('embedding', 0):.1f} | {timings.get('retrieval', 0):.1f} | {counters.get('prompt_tokens', 0)} | {counters.get('completion_tokens', 0)} |")
+
 def parse_json_report(report_path: str):
     with open(report_path, 'r') as f:
         report_data = jsonpickle.decode(f.read())
@@ -203,6 +223,8 @@ if __name__ == "__main__":
 
     display_detailed_stats("Per example results", results)
 
+    display_metrics("Time and Tokens", results)
+
     if (args.baselinedir is not None):
         baseline = parse_reports(args.baselinedir)
         diff_stats = compare_to_baseline(results, baseline)
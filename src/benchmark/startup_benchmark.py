@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules run as scripts or imported by tools, from the lightest expected to the heaviest
+ENTRY_POINTS = [
+    "upgraider.fix_client",
+    "upgraider.update_brushes_code",
+    "benchmark.parse_reports",
+    "upgraider.run_code",
+    "upgraider.Model",
+    "upgraider.fix_lib_examples",
+    "upgraider.run_experiment",
+    "upgraider.fix_server",
+    "upgraider.build_index",
+    "upgraider.populate_doc_db",
+]
+
+def import_times(module: str, python: str = sys.executable) -> list[(int, str, int)]:
+    """
+    Run `python -X importtime -c "import module"` and return (nesting level, module, cumulative microseconds)
+    for every module it imported, in the order of the importtime output
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [src_dir, os.path.join(src_dir, "upgraider")] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    result = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not import {module}: {result.stderr.strip().splitlines()[-1]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((level, name.strip(), int(cumulative)))
+    return times
+
+def measure(module: str, runs: int, top: int) -> dict:
+    """
+    Median total import time of the module over runs, and its top direct imports by cumulative time
+    """
+    totals = []
+    for _ in range(runs):
+        times = import_times(module)
+        # modules imported while the module runs (e.g. plugins) may be listed after it
+        position = max(i for i, (level, name, _) in enumerate(times) if level == 0 and name == module)
+        totals.append(times[position][2])
+
+    # the direct imports of the module are listed just before it; earlier ones are those of the interpreter startup
+    direct_imports = []
+    for level, name, cumulative in reversed(times[:position]):
+        if level == 0:
+            break
+        if level == 1:
+            direct_imports.append((cumulative, name))
+    direct_imports.sort(reverse=True)
+    return {
+        "total_ms": statistics.median(totals) / 1000,
+        "heaviest": {name: cumulative / 1000 for cumulative, name in direct_imports[:top]},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of each entry point with python -X importtime')
+    parser.add_argument('--runs', type=int, help='number of runs per entry point, the median is reported', default=5)
+    parser.add_argument('--top', type=int, help='number of heaviest direct imports to show per entry point', default=3)
+    parser.add_argument('--output', type=str, help='save the results to this json file', default=None)
+    parser.add_argument('--baseline', type=str, help='json file of earlier results to compare to', default=None)
+    parser.add_argument('modules', nargs='*', help='entry points to measure (default: all)')
+
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f"| Entry point | Import time (ms) | Baseline (ms) | Heaviest direct imports (ms) |")
+    print(f"| --- | --: | --: | --- |")
+    for module in args.modules or ENTRY_POINTS:
+        results[module] = measure(module, args.runs, args.top)
+
+        baseline_ms = f"{baseline[module]['total_ms']:.0f}" if module in baseline else "--"
+        heaviest = ", ".join(f"{name} {ms:.0f}" for name, ms in results[module]["heaviest"].items())
+        print(f"| {module} | {results[module]['total_ms']:.0f} | {baseline_ms} | {heaviest} |")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,307 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.orm import declarative_base, sessionmaker, deferred, undefer
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import Column, Integer, String, LargeBinary, Text, cast
+from sqlalchemy.types import TypeDecorator
+from upgraider.EmbeddingIndex import EmbeddingIndex, ShardedIndex, save_folder
+from upgraider.SectionTable import SectionTable
+import numpy as np
+import threading
+import sqlite3
+import hashlib
+import re
+import struct
 import json
 import os
 
 script_path = os.path.dirname(os.path.realpath(__file__))
+db_path = f"{script_path}/resources/database/releasenotes.db"
 Base = declarative_base()
 engine = create_engine(
-    f"sqlite:///{script_path}/resources/database/releasenotes.db",
+    f"sqlite:///{db_path}",
     echo=False,
 )
 Session = sessionmaker(bind=engine)
 
+def enable_wal(engine):
+    """
+    Use write-ahead logging on every connection of the engine, so that commits do not each
+    rewrite the database file and readers are not blocked while release notes are ingested.
+    Called by the tools that write the DB (populate_doc_db.py, migrate_db.py) before they connect;
+    the journal mode is then stored in the DB file, so readers need not change their connections.
+    """
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
+# Embeddings are stored as a 16 byte header followed by the raw vector:
+# magic, numpy dtype string (e.g. b"<f4"), format version and dimension
+EMBEDDING_MAGIC = b"UPEM"
+EMBEDDING_FORMAT_VERSION = 1
+EMBEDDING_DTYPE = np.dtype("<f4")
+EMBEDDING_HEADER = struct.Struct("<4s4sII")
+
+# snapshot of the index and the sections saved by build_index.py; when it is missing or out of date,
+# an exact index is built from the database
+SNAPSHOT_META_FILE = "snapshot.json"
+embedding_index_path = os.environ.get("UPGRAIDER_EMBEDDING_INDEX", f"{script_path}/resources/database/releasenotes.index")
+
+# built lazily by get_embedding_index, then shared by all queries of this process
+_embedding_index = None
+_embedding_index_lock = threading.Lock()
+
+class EmbeddingColumn(TypeDecorator):
+    """
+    Binary float32 embedding (see encode_embedding). Values are returned as stored and
+    decoded by DeprecationComment.embedding_vector, so databases that still hold the
+    legacy JSON text embeddings remain readable until they are migrated.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        return encode_embedding(value)
+
+    def result_processor(self, dialect, coltype):
+        return None
+
 class LibReleaseNote(Base):
     __tablename__ = "lib_release_notes"
     id = Column(Integer, primary_key=True)
     library = Column(String)
     version = Column(String)
     filename = Column(String)
+    # sha256 of the release note file, used to only re-ingest notes that changed
+    content_hash = deferred(Column(String))
 
 class DeprecationComment(Base):
     __tablename__ = "deprecation_comments"
     id = Column(Integer, primary_key=True)
     lib_release_note = Column(Integer)
     content = Column(String)
-    embedding = Column(Text)
+    embedding = Column(EmbeddingColumn)
+    # sha256 of content, used to only re-embed items that changed
+    content_hash = deferred(Column(String))
+    # number of tokens the content takes as a reference in a prompt, counted at ingestion time
+    num_tokens = deferred(Column(Integer))
+
+    @property
+    def embedding_vector(self) -> np.ndarray:
+        return decode_embedding(self.embedding)
+
+
+def hash_content(content: str | bytes) -> str:
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def encode_embedding(embedding: list[float]) -> bytes:
+    """
+    Encode an embedding into its binary (float32) representation for storage in the database
+    """
+    if embedding is None:
+        return None
+
+    vector = np.asarray(embedding, dtype=EMBEDDING_DTYPE)
+    header = EMBEDDING_HEADER.pack(
+        EMBEDDING_MAGIC,
+        EMBEDDING_DTYPE.str.encode("ascii"),
+        EMBEDDING_FORMAT_VERSION,
+        len(vector),
+    )
+    return header + vector.tobytes()
+
+def decode_embedding(data: bytes | str) -> np.ndarray:
+    """
+    Decode a stored embedding. Binary embeddings are read without copying (the returned array is read-only);
+    JSON text embeddings from databases that were not migrated yet are parsed as before.
+    """
+    if data is None:
+        return None
+
+    if isinstance(data, str):
+        embedding = json.loads(data)
+        return np.asarray(embedding, dtype=EMBEDDING_DTYPE) if embedding is not None else None
+
+    magic, dtype, version, dim = EMBEDDING_HEADER.unpack_from(data)
+    if magic != EMBEDDING_MAGIC or version != EMBEDDING_FORMAT_VERSION:
+        raise ValueError(f"Unsupported embedding format (magic {magic}, version {version})")
+
+    return np.frombuffer(data, dtype=np.dtype(dtype.rstrip(b"\0").decode("ascii")), count=dim, offset=EMBEDDING_HEADER.size)
 
 
 def get_embedded_doc_sections() -> list[DeprecationComment]:
+    """
+    The deprecation comments that have an embedding. Databases that were not migrated yet have no token
+    counts; their sections get a num_tokens of None, so the tokens are counted when the sections are used.
+    """
     session = Session()
-    sections = (
+    columns = {column["name"] for column in inspect(session.connection()).get_columns(DeprecationComment.__tablename__)}
+    has_token_counts = "num_tokens" in columns
+
+    query = (
         session.query(DeprecationComment)
-        .filter(DeprecationComment.embedding != "NULL")
+        .filter(cast(DeprecationComment.embedding, Text) != "NULL")
         .filter(DeprecationComment.embedding != None)
-        .all()
     )
+    if has_token_counts:
+        query = query.options(undefer(DeprecationComment.num_tokens))
+    sections = query.all()
+
+    if not has_token_counts:
+        for section in sections:
+            set_committed_value(section, "num_tokens", None)
 
     session.close()
     return sections
 
 def load_embeddings(
     sections: list[DeprecationComment],
-) -> dict[int, list[float]]:
+) -> dict[int, np.ndarray]:
     """
     Read the section embeddings and their keys from the database
     """
 
-    return {
-        section.id: json.loads(section.embedding)
+    embeddings = {
+        section.id: section.embedding_vector
         for section in sections
-    }
\ No newline at end of file
+    }
+
+    return {id: embedding for id, embedding in embeddings.items() if embedding is not None}
+
+def get_release_notes() -> dict[int, LibReleaseNote]:
+    session = Session()
+    release_notes = {release_note.id: release_note for release_note in session.query(LibReleaseNote).all()}
+    session.close()
+    return release_notes
+
+def version_key(version: str) -> tuple[int, ...]:
+    """
+    Comparable form of a version such as "v1.22.3" or "3.0". Trailing zeros are dropped, so that 3.0 == 3.0.0.
+    """
+    numbers = [int(number) for number in re.findall(r"\d+", version)]
+    while numbers and numbers[-1] == 0:
+        numbers.pop()
+    return tuple(numbers)
+
+def in_release_scope(key: tuple, library: str, base_version: str = None, current_version: str = None) -> bool:
+    """
+    Whether the release notes of the partition key (library, version) describe an upgrade of library
+    from base_version (excluded) to current_version (included). Notes of unknown version are kept.
+    """
+    partition_library, version = key
+    if partition_library != library:
+        return False
+    if version is None:
+        return True
+    if base_version is not None and version_key(version) <= version_key(base_version):
+        return False
+    if current_version is not None and version_key(version) > version_key(current_version):
+        return False
+    return True
+
+def partition_sections(
+    sections: list[DeprecationComment],
+    release_notes: dict[int, LibReleaseNote],
+) -> dict[tuple, list[DeprecationComment]]:
+    """
+    Group the sections by the (library, version) of their release note
+    """
+    partitions = {}
+    for section in sections:
+        release_note = release_notes.get(section.lib_release_note)
+        key = (release_note.library, release_note.version) if release_note is not None else (None, None)
+        partitions.setdefault(key, []).append(section)
+    return partitions
+
+def build_sharded_index(partitions: dict[tuple, list[DeprecationComment]]) -> ShardedIndex:
+    """
+    Exact index with one shard per partition
+    """
+    sections = {section.id: section for partition in partitions.values() for section in partition}
+    shards = {key: EmbeddingIndex.from_embeddings(load_embeddings(partition), partition) for key, partition in partitions.items()}
+    return ShardedIndex(shards, sections)
+
+def database_fingerprint(path: str) -> str:
+    """
+    Hash of the release notes and of the largest deprecation comment id. populate_doc_db.py changes the content hash
+    of every release note whose items it adds or removes, so the hash changes with the indexed sections.
+    Read with sqlite3 directly from small tables and the primary key, which takes milliseconds.
+
+    Rows updated in place are not noticed: migrate_db.py only changes how embeddings are stored and fills in
+    token counts and content hashes, which leaves the snapshot valid, but any other in-place edit of the
+    deprecation comments needs build_index.py to be run again.
+    """
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        # databases that were not migrated yet have no content hashes, which is the same as hashes that are not set
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(lib_release_notes)")}
+        content_hash = "content_hash" if "content_hash" in columns else "NULL"
+        release_notes = connection.execute(
+            f"SELECT id, library, version, {content_hash} FROM lib_release_notes ORDER BY id"
+        ).fetchall()
+        max_comment_id = connection.execute("SELECT MAX(id) FROM deprecation_comments").fetchone()[0]
+    finally:
+        connection.close()
+    return hash_content(json.dumps([release_notes, max_comment_id]))
+
+def save_snapshot(index: ShardedIndex, sections: list[DeprecationComment], path: str):
+    """
+    Save the index and the text of its sections to the folder path, so that get_embedding_index can load
+    them without the database. The fingerprint of the database is the metadata of the snapshot.
+    """
+    index.save(path)
+    SectionTable.from_sections(sections).save(os.path.join(path, "sections"))
+    save_folder(path, {}, SNAPSHOT_META_FILE, {"fingerprint": database_fingerprint(db_path)})
+
+def load_snapshot(path: str) -> ShardedIndex:
+    """
+    Memory-map the snapshot saved at path, or return None if there is none or the database changed since it was saved.
+    A snapshot is used as is when there is no database at all, or when it cannot be read (e.g. it is a git-lfs
+    pointer that was never pulled).
+    """
+    if not os.path.exists(os.path.join(path, SNAPSHOT_META_FILE)):
+        return None
+
+    with open(os.path.join(path, SNAPSHOT_META_FILE), 'r') as f:
+        meta = json.load(f)
+
+    if os.path.exists(db_path):
+        try:
+            fingerprint = database_fingerprint(db_path)
+        except sqlite3.DatabaseError as e:
+            print(f"WARNING: cannot read {db_path} ({e}), using embedding snapshot {path} as is")
+            fingerprint = meta["fingerprint"]
+
+        if meta["fingerprint"] != fingerprint:
+            print(f"WARNING: embedding snapshot {path} is out of date, run build_index.py to rebuild it")
+            return None
+
+    return ShardedIndex.load(path, SectionTable.load(os.path.join(path, "sections")))
+
+def get_embedding_index(library: str = None, base_version: str = None, current_version: str = None) -> ShardedIndex:
+    """
+    Return the embedding index over the embedded documentation sections of the release notes of library
+    between base_version and current_version (see in_release_scope), or over all sections if library is None.
+
+    The index is sharded by library and version, so only the shards in scope are searched. It is the snapshot saved
+    at embedding_index_path if it is up to date, otherwise an exact index built from the database.
+    It is loaded on first use and then reused for the lifetime of the process.
+    """
+    global _embedding_index
+
+    with _embedding_index_lock:
+        if _embedding_index is None:
+            _embedding_index = load_snapshot(embedding_index_path)
+            if _embedding_index is None:
+                _embedding_index = build_sharded_index(partition_sections(get_embedded_doc_sections(), get_release_notes()))
+
+    if library is None:
+        return _embedding_index
+    return _embedding_index.scoped(lambda key: in_release_scope(key, library, base_version, current_version))
@@ -0,0 +1,134 @@
+import sqlite3
+import threading
+import time
+import os
+from contextlib import contextmanager
+
+
+class DiskCache:
+    """
+    Persistent key-value cache backed by a single sqlite file.
+
+    Values are bytes. Reads refresh the last access time of the entry (at most once per refresh_interval
+    seconds, so that most reads do not write), and when the cache grows beyond max_entries entries or
+    max_bytes bytes of values, the least recently used entries are evicted. The number of entries and
+    their total size are kept up to date by triggers in a one-row stats table, so checking the limits
+    does not scan the cache. The cache can be shared by several threads and processes.
+    """
+
+    def __init__(self, path: str, max_entries: int = None, max_bytes: int = None, refresh_interval: float = 60):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.refresh_interval_ns = int(refresh_interval * 1e9)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access INTEGER)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self._create_stats()
+
+    def _create_stats(self):
+        with self._transaction():
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_stats (id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER, bytes INTEGER)"
+            )
+            self._connection.execute("""
+                CREATE TRIGGER IF NOT EXISTS cache_stats_insert AFTER INSERT ON cache BEGIN
+                    UPDATE cache_stats SET entries = entries + 1, bytes = bytes + new.size;
+                END""")
+            self._connection.execute("""
+                CREATE TRIGGER IF NOT EXISTS cache_stats_delete AFTER DELETE ON cache BEGIN
+                    UPDATE cache_stats SET entries = entries - 1, bytes = bytes - old.size;
+                END""")
+            self._connection.execute("""
+                CREATE TRIGGER IF NOT EXISTS cache_stats_update AFTER UPDATE OF size ON cache BEGIN
+                    UPDATE cache_stats SET bytes = bytes - old.size + new.size;
+                END""")
+            # caches created before the stats table are counted once
+            self._connection.execute(
+                "INSERT OR IGNORE INTO cache_stats SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM cache"
+            )
+
+    @contextmanager
+    def _transaction(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def _stats(self) -> (int, int):
+        return self._connection.execute("SELECT entries, bytes FROM cache_stats").fetchone()
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            row = self._connection.execute("SELECT value, last_access FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            now = time.time_ns()
+            if now - row[1] >= self.refresh_interval_ns:
+                self._connection.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, key: str, value: bytes):
+        with self._lock, self._transaction():
+            self._connection.execute(
+                "INSERT INTO cache (key, value, size, last_access) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, last_access = excluded.last_access",
+                (key, value, len(value), time.time_ns()),
+            )
+            self._evict()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._stats()[0]
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._stats()[1]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self):
+        """
+        Remove least recently used entries until the cache respects its limits.
+        Must hold the lock, in the transaction that added the entry.
+        """
+        if self.max_entries is None and self.max_bytes is None:
+            return
+
+        num_entries, num_bytes = self._stats()
+
+        excess_entries = num_entries - self.max_entries if self.max_entries is not None else 0
+        excess_bytes = num_bytes - self.max_bytes if self.max_bytes is not None else 0
+
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return
+
+        evicted = []
+        for key, size in self._connection.execute("SELECT key, size FROM cache ORDER BY last_access"):
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            evicted.append((key,))
+            excess_entries -= 1
+            excess_bytes -= size
+
+        self._connection.executemany("DELETE FROM cache WHERE key = ?", evicted)
@@ -0,0 +1,327 @@
+import json
+import os
+import numpy as np
+
+# an index saved to disk is a folder holding this file and one .npy file per array
+INDEX_META_FILE = "index.json"
+# a sharded index is a folder holding this file and one folder per shard
+SHARDS_META_FILE = "shards.json"
+INDEX_FORMAT_VERSION = 1
+
+def save_folder(path: str, arrays: dict[str, np.ndarray], meta_file: str, meta: dict):
+    """
+    Save the arrays as .npy files in the folder path, then meta as JSON in meta_file. Loading starts from
+    the metadata file, which is written last, so an interrupted save is not loadable.
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+    with open(os.path.join(path, meta_file), 'w') as f:
+        json.dump(meta, f)
+
+
+class EmbeddingIndex:
+    """
+    In-memory index over the embeddings of the documentation sections.
+
+    The embeddings are stored as one contiguous float32 matrix (one row per section)
+    together with an array holding the id of the section in each row, so that a query
+    is answered with a single matrix-vector product instead of one dot product per section.
+    The sections themselves are kept in a map from id to section, built once with the index.
+    """
+
+    KIND = "exact"
+    ARRAYS = ["ids", "matrix"]
+
+    def __init__(self, ids: np.ndarray, matrix: np.ndarray, sections: dict[int, object] = None):
+        if len(ids) != len(matrix):
+            raise ValueError(f"Got {len(ids)} ids for {len(matrix)} embeddings")
+
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.sections = sections if sections is not None else {}
+
+    @classmethod
+    def from_embeddings(cls, embeddings: dict[int, list[float]], sections: list = None) -> "EmbeddingIndex":
+        """
+        Build the index from a dictionary of section id -> embedding (as returned by load_embeddings)
+        and optionally the sections these embeddings belong to
+        """
+        ids = np.fromiter(embeddings.keys(), dtype=np.int64, count=len(embeddings))
+        sections_by_id = {section.id: section for section in sections} if sections is not None else None
+
+        if len(embeddings) == 0:
+            return cls(ids, np.empty((0, 0), dtype=np.float32), sections_by_id)
+
+        matrix = np.array(list(embeddings.values()), dtype=np.float32)
+        return cls(ids, matrix, sections_by_id)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get_section(self, section_id: int):
+        return self.sections[section_id]
+
+    def settings(self) -> dict:
+        """
+        Parameters of the index, other than its arrays, that are saved with it
+        """
+        return {}
+
+    def save(self, path: str):
+        """
+        Save the index to the folder path
+        """
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        save_folder(path, arrays, INDEX_META_FILE, {"kind": self.KIND, "format_version": INDEX_FORMAT_VERSION, **self.settings()})
+
+    @staticmethod
+    def load(path: str, sections: dict[int, object] = None, **settings) -> "EmbeddingIndex":
+        """
+        Load an index saved with save, of whichever kind it is. The arrays are memory-mapped rather than read,
+        so loading takes the same time for any corpus size. settings override the saved ones (e.g. nprobe).
+        """
+        with open(os.path.join(path, INDEX_META_FILE), 'r') as f:
+            meta = json.load(f)
+
+        if meta.pop("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format in {path}")
+
+        index_class = INDEX_KINDS[meta.pop("kind")]
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in index_class.ARRAYS}
+        return index_class(**arrays, sections=sections, **{**meta, **settings})
+
+    def search(
+        self,
+        query_embedding: list[float],
+        k: int = None,
+        threshold: float = None,
+    ) -> list[(float, int)]:
+        """
+        Return (similarity, section id) pairs for the k most similar sections, sorted by similarity
+        in descending order. If k is None, all sections are returned. If threshold is set, only
+        sections whose similarity is strictly above it are kept.
+
+        Because OpenAI Embeddings are normalized to length 1, the cosine similarity is the same as the dot product.
+        """
+        if query_embedding is None or len(self) == 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        similarities = self.matrix @ query
+        return self._rank(similarities, self.ids, k, threshold)
+
+    @staticmethod
+    def _rank(similarities: np.ndarray, ids: np.ndarray, k: int, threshold: float) -> list[(float, int)]:
+        """
+        The (similarity, id) pairs of the k most similar candidates above threshold, in descending order of similarity
+        """
+        candidates = np.arange(len(similarities))
+        if threshold:
+            candidates = np.flatnonzero(similarities > threshold)
+
+        if k is not None and k < len(candidates):
+            # only the top k need to be sorted
+            top_k = np.argpartition(-similarities[candidates], k - 1)[:k]
+            candidates = candidates[top_k]
+
+        # stable sort so that ties keep the order of the rows
+        order = np.argsort(-similarities[candidates], kind="stable")
+        candidates = candidates[order]
+
+        return list(zip(similarities[candidates].tolist(), ids[candidates].tolist()))
+
+
+class IVFIndex(EmbeddingIndex):
+    """
+    Approximate index over the same embeddings (an inverted file index).
+
+    The embeddings are clustered around num_lists centroids with spherical k-means, and the rows of the
+    matrix are ordered by cluster, so each cluster is a contiguous slice given by list_offsets.
+    A query is only compared to the sections of the nprobe clusters whose centroids are most similar to it,
+    which scans about nprobe / num_lists of the corpus. Sections in the other clusters are missed, so
+    the results are a close approximation of those of EmbeddingIndex; a larger nprobe trades speed for recall.
+    """
+
+    KIND = "ivf"
+    ARRAYS = ["ids", "matrix", "centroids", "list_offsets"]
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        matrix: np.ndarray,
+        centroids: np.ndarray,
+        list_offsets: np.ndarray,
+        sections: dict[int, object] = None,
+        nprobe: int = 8,
+    ):
+        super().__init__(ids, matrix, sections)
+        if len(list_offsets) != len(centroids) + 1 or (len(list_offsets) > 0 and list_offsets[-1] != len(ids)):
+            raise ValueError(f"Got {len(list_offsets)} list offsets for {len(centroids)} lists of {len(ids)} embeddings")
+
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.nprobe = nprobe
+
+    @property
+    def num_lists(self) -> int:
+        return len(self.centroids)
+
+    def settings(self) -> dict:
+        return {"nprobe": self.nprobe}
+
+    @classmethod
+    def build(
+        cls,
+        index: EmbeddingIndex,
+        num_lists: int = None,
+        nprobe: int = 8,
+        iterations: int = 10,
+        max_training_rows: int = 256,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """
+        Cluster the embeddings of the exact index. num_lists defaults to the square root of the number of sections.
+        The centroids are trained on at most max_training_rows rows per list, then every row is assigned to its closest centroid.
+        """
+        if num_lists is None:
+            num_lists = int(np.sqrt(len(index)))
+        num_lists = max(min(num_lists, len(index)), 1 if len(index) > 0 else 0)
+
+        rng = np.random.default_rng(seed)
+        training_rows = len(index)
+        if training_rows > num_lists * max_training_rows:
+            training_rows = num_lists * max_training_rows
+        training = index.matrix[np.sort(rng.choice(len(index), training_rows, replace=False))]
+
+        centroids = training[rng.choice(len(training), num_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = _closest_centroids(training, centroids)
+            for list_id in range(num_lists):
+                members = training[assignments == list_id]
+                # an empty cluster is moved to a random row, so that all lists stay in use
+                centroid = members.sum(axis=0) if len(members) > 0 else training[rng.integers(len(training))]
+                centroids[list_id] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+        assignments = _closest_centroids(index.matrix, centroids)
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=num_lists))
+
+        return cls(index.ids[order], index.matrix[order], centroids, list_offsets, index.sections, nprobe)
+
+    def search(
+        self,
+        query_embedding: list[float],
+        k: int = None,
+        threshold: float = None,
+    ) -> list[(float, int)]:
+        """
+        Same as EmbeddingIndex.search, among the sections of the nprobe clusters closest to the query
+        """
+        if query_embedding is None or len(self) == 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        nprobe = min(self.nprobe, self.num_lists)
+        probed_lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        # scan the lists in row order, so that ties are broken as in the exact index
+        probed_lists.sort()
+
+        rows = [np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in probed_lists]
+        similarities = [self.matrix[self.list_offsets[i]:self.list_offsets[i + 1]] @ query for i in probed_lists]
+        rows = np.concatenate(rows)
+        return self._rank(np.concatenate(similarities), self.ids[rows], k, threshold)
+
+
+def _closest_centroids(matrix: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """
+    Index of the most similar centroid of each row, computed by chunks of rows to bound memory
+    """
+    assignments = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), chunk_size):
+        assignments[start:start + chunk_size] = np.argmax(matrix[start:start + chunk_size] @ centroids.T, axis=1)
+    return assignments
+
+
+class ShardedIndex:
+    """
+    Index partitioned into shards (e.g. one per library release), each an EmbeddingIndex or IVFIndex.
+
+    scoped returns an index over some of the shards only, so a query is never scored against
+    sections outside of its scope. Searching several shards merges their results.
+    """
+
+    def __init__(self, shards: dict[tuple, EmbeddingIndex], sections: dict[int, object] = None):
+        self.shards = shards
+        self.sections = sections if sections is not None else {}
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards.values())
+
+    def get_section(self, section_id: int):
+        return self.sections[section_id]
+
+    def scoped(self, in_scope) -> "ShardedIndex":
+        """
+        Index over the shards whose key satisfies in_scope
+        """
+        return ShardedIndex({key: shard for key, shard in self.shards.items() if in_scope(key)}, self.sections)
+
+    def search(
+        self,
+        query_embedding: list[float],
+        k: int = None,
+        threshold: float = None,
+    ) -> list[(float, int)]:
+        """
+        Same as EmbeddingIndex.search, over all shards
+        """
+        results = []
+        for shard in self.shards.values():
+            results += shard.search(query_embedding, k=k, threshold=threshold)
+
+        results.sort(key=lambda result: -result[0])
+        return results[:k] if k is not None else results
+
+    def save(self, path: str):
+        """
+        Save the index to the folder path. The arrays of all shards are concatenated into one .npy file per array,
+        so loading takes a few file opens however many shards there are.
+        """
+        arrays = {}
+        shards = []
+        for key, shard in self.shards.items():
+            ranges = {}
+            for name in shard.ARRAYS:
+                parts = arrays.setdefault(name, [])
+                start = sum(len(part) for part in parts)
+                parts.append(getattr(shard, name))
+                ranges[name] = [start, start + len(parts[-1])]
+            shards.append({"key": list(key), "kind": shard.KIND, "settings": shard.settings(), "ranges": ranges})
+
+        # empty shards may not have the dimension of the others
+        arrays = {name: np.concatenate([part for part in parts if len(part) > 0] or parts[:1]) for name, parts in arrays.items()}
+        save_folder(path, arrays, SHARDS_META_FILE, {"format_version": INDEX_FORMAT_VERSION, "arrays": list(arrays), "shards": shards})
+
+    @classmethod
+    def load(cls, path: str, sections: dict[int, object] = None) -> "ShardedIndex":
+        """
+        Load a sharded index saved with save. The arrays are memory-mapped and each shard is a view on its rows.
+        """
+        with open(os.path.join(path, SHARDS_META_FILE), 'r') as f:
+            meta = json.load(f)
+
+        if meta["format_version"] != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format in {path}")
+
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in meta["arrays"]}
+        shards = {}
+        for shard in meta["shards"]:
+            shard_arrays = {name: arrays[name][start:end] for name, (start, end) in shard["ranges"].items()}
+            shards[tuple(shard["key"])] = INDEX_KINDS[shard["kind"]](**shard_arrays, sections=sections, **shard["settings"])
+        return cls(shards, sections)
+
+
+INDEX_KINDS = {index_class.KIND: index_class for index_class in [EmbeddingIndex, IVFIndex]}
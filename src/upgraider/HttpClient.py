@@ -0,0 +1,240 @@
+import asyncio
+import contextlib
+import email.utils
+import random
+import threading
+import time
+import weakref
+
+# responses worth retrying: rate limited, or a transient problem on the server side
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """
+    A failed attempt that may succeed if tried again, optionally after the delay the server asked for
+    """
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a service that failed too many times in a row
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failed attempts. While open, calls fail immediately;
+    after reset_timeout seconds one trial call is let through, and its success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Circuit open after {self.failures} consecutive failures")
+
+            # half open: let this call through, the next failure opens the circuit again
+            self.opened_at = None
+            self.failures = self.failure_threshold - 1
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def parse_retry_after(value: str) -> float:
+    """
+    Seconds to wait according to a Retry-After header, which holds either seconds or an HTTP date
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class HttpClient:
+    """
+    Client for one service, shared by all threads: a pooled keep-alive session, timeouts,
+    retries with exponential backoff and full jitter (honoring Retry-After), and a circuit breaker.
+    The *_async methods do the same from an asyncio event loop, with one pooled aiohttp session per loop.
+    requests and aiohttp are only imported when a client is created.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        pool_size: int = 16,
+        circuit_breaker: CircuitBreaker = None,
+    ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = (connect_timeout, read_timeout)
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+
+        import requests.adapters
+
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._async_sessions = weakref.WeakKeyDictionary()
+
+    def async_session(self) -> "aiohttp.ClientSession":
+        """
+        The aiohttp session of the running event loop, created on first use
+        """
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+            )
+            self._async_sessions[loop] = session
+        return session
+
+    async def close_async(self):
+        """
+        Close the aiohttp session of the running event loop
+        """
+        session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, send):
+        """
+        Return send(), calling it again after a backoff whenever it raises RetryableError,
+        up to max_retries times. Other exceptions are not retried.
+        """
+        attempt = 0
+        while True:
+            self.circuit_breaker.before_call()
+            try:
+                result = send()
+            except RetryableError as e:
+                self.circuit_breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+
+                delay = self.backoff(attempt, e.retry_after)
+                print(f"WARNING: {e}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self.circuit_breaker.record_success()
+            return result
+
+    async def call_async(self, send):
+        """
+        Same as call, for a coroutine function send. Backoffs do not block the event loop.
+        """
+        attempt = 0
+        while True:
+            self.circuit_breaker.before_call()
+            try:
+                result = await send()
+            except RetryableError as e:
+                self.circuit_breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+
+                delay = self.backoff(attempt, e.retry_after)
+                print(f"WARNING: {e}, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            self.circuit_breaker.record_success()
+            return result
+
+    def post_json(self, url: str, json_data: dict, headers: dict = None) -> dict:
+        """
+        POST json_data to url and return the decoded JSON response
+        """
+        import requests
+
+        def send() -> dict:
+            try:
+                response = self.session.post(url, json=json_data, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise RetryableError(f"Request to {url} failed: {e}")
+
+            if response.status_code in RETRY_STATUS_CODES:
+                raise RetryableError(
+                    f"Request to {url} failed with status {response.status_code}",
+                    retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                )
+
+            response.raise_for_status()
+            return response.json()
+
+        return self.call(send)
+
+    async def post_json_async(self, url: str, json_data: dict, headers: dict = None, semaphore: asyncio.Semaphore = None) -> dict:
+        """
+        Same as post_json, from an asyncio event loop. If given, semaphore is held during each attempt,
+        but not during the backoffs between attempts.
+        """
+        import aiohttp
+
+        async def send() -> dict:
+            try:
+                async with semaphore or contextlib.nullcontext(), \
+                        self.async_session().post(url, json=json_data, headers=headers) as response:
+                    if response.status in RETRY_STATUS_CODES:
+                        raise RetryableError(
+                            f"Request to {url} failed with status {response.status}",
+                            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                        )
+
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                raise RetryableError(f"Request to {url} failed: {e!r}")
+
+        return await self.call_async(send)
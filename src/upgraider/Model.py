@@ -1,31 +1,66 @@
 # some code in this script is based off https://github.com/openai/openai-cookbook/blob/main/examples/Question_answering_using_embeddings.ipynb 
 
 import numpy as np
-import openai
-import tiktoken
 from os import environ as env
 from dotenv import load_dotenv
 from string import Template
 import os
 import re
-from upgraider.Database import load_embeddings, get_embedded_doc_sections
+from upgraider.EmbeddingIndex import EmbeddingIndex
+from upgraider.DiskCache import DiskCache
+from upgraider.RateLimiter import RateLimiter
+from upgraider.HttpClient import HttpClient, RetryableError, parse_retry_after
+from upgraider.instrumentation import span, count, current_metrics
+from upgraider.tokenizer import get_encoding, count_tokens, reference_text
 from upgraider.Report import UpdateStatus, ModelResponse, DBSource
+from apiexploration.Library import Library
 import logging as log
-import requests
+import hashlib
 import json
+import threading
+import asyncio
+import atexit
+import contextvars
+import weakref
 
 load_dotenv(override=True)
 
 EMBEDDING_MODEL = "text-embedding-ada-002"
 
-#TODO: use token length
-MAX_SECTION_LEN = 500
-SEPARATOR = "\n* "
-
-ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
- 
-encoding = tiktoken.get_encoding(ENCODING)
-separator_len = len(encoding.encode(SEPARATOR))
+# embeddings are cached on disk (keyed on the model and the text), so the same text
+# is only sent to the embeddings endpoint once, across runs and across ingestion/querying
+CACHE_DIR = env.get("UPGRAIDER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "upgraider"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(env.get("UPGRAIDER_EMBEDDING_CACHE_MAX_ENTRIES", 200_000))
+EMBEDDING_CACHE_MAX_BYTES = int(env.get("UPGRAIDER_EMBEDDING_CACHE_MAX_MB", 1024)) * 1024 * 1024
+_embedding_cache = None
+# the disk caches are opened on first use, possibly by several threads at once
+_cache_lock = threading.Lock()
+
+# limits for multi-input embedding requests; tokens are counted with the cl100k_base encoding
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+EMBEDDING_BATCH_MAX_INPUTS = 2048
+EMBEDDING_BATCH_MAX_TOKENS = 32_000
+
+# The references get what is left of the context window of the model once the prompt template,
+# the code and the response are accounted for, but at most MAX_REFERENCE_TOKENS tokens
+MAX_REFERENCE_TOKENS = int(env.get("UPGRAIDER_MAX_REFERENCE_TOKENS", 700))
+MODEL_CONTEXT_WINDOWS = {"gpt-3.5": 4096, "gpt-4": 8192}
+# tokens the chat format adds around each message
+CHAT_MESSAGE_OVERHEAD_TOKENS = 4
+# a reference truncated to fewer tokens than this is left out instead
+MIN_TRUNCATED_REFERENCE_TOKENS = 16
+MAX_SECTION_LEN = 500 # words, for ready context
+
+# number of most similar sections requested from the index at first;
+# doubled whenever more candidates are needed to fill the references
+REFERENCE_CANDIDATES = 64
+
+# Heavy dependencies are only loaded when first needed, so that importing this module stays fast:
+# the tokenizer (see tokenizer.get_encoding), openai, and the database (SQLAlchemy) are imported by the functions using them.
+
+_chat_template = None
+
+SYSTEM_MESSAGE = "You are a smart code reviewer who can spot code that uses a non-existent or deprecated API."
 
 COMPLETIONS_API_PARAMS = {
     "temperature": 0.0,
@@ -38,6 +73,233 @@ GPT_3_5_TURBO_API_PARAMS = {
     "model": "gpt-3.5-turbo"
 }
 
+GPT4_MAX_TOKENS = 300
+
+# Responses of the fixing models are deterministic (temperature 0), so they are cached on disk, keyed
+# on the endpoint and the full request. The mode decides how the cache is used:
+#   record: answer from the cache when possible, otherwise call the model and store its response
+#   replay: only answer from the cache, never call the model (fails on requests that were not recorded)
+#   bypass: always call the model and leave the cache untouched
+RESPONSE_CACHE_MODES = ["record", "replay", "bypass"]
+RESPONSE_CACHE_MAX_ENTRIES = int(env.get("UPGRAIDER_RESPONSE_CACHE_MAX_ENTRIES", 100_000))
+_response_cache_mode = env.get("UPGRAIDER_RESPONSE_CACHE", "record")
+_response_cache = None
+
+# one client per model service, so that each has its own connection pool and circuit breaker
+HTTP_MAX_RETRIES = int(env.get("UPGRAIDER_HTTP_MAX_RETRIES", 5))
+HTTP_CONNECT_TIMEOUT = float(env.get("UPGRAIDER_HTTP_CONNECT_TIMEOUT", 10))
+HTTP_READ_TIMEOUT = float(env.get("UPGRAIDER_HTTP_READ_TIMEOUT", 120))
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+
+# The model calls are implemented as coroutines. At most MAX_CONCURRENT_REQUESTS requests are sent at
+# the same time from each event loop. The synchronous functions run the coroutines on a shared event
+# loop in a background thread, so sync callers in several threads also share its connections and limit.
+MAX_CONCURRENT_REQUESTS = int(env.get("UPGRAIDER_MAX_CONCURRENT_REQUESTS", 16))
+_request_semaphores = weakref.WeakKeyDictionary()
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+class ResponseNotRecorded(Exception):
+    """
+    Raised in replay mode for a request whose response is not in the cache
+    """
+
+# throttles the requests to the fixing models when set (see set_rate_limits)
+_rate_limiter = None
+
+def set_rate_limits(requests_per_minute: int = None, tokens_per_minute: int = None):
+    """
+    Limit the requests to the fixing models (shared by all threads) to the given per-minute budgets.
+    Passing no budget removes the limits.
+    """
+    global _rate_limiter
+
+    if requests_per_minute or tokens_per_minute:
+        _rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    else:
+        _rate_limiter = None
+
+def get_http_client(service: str) -> HttpClient:
+    with _http_clients_lock:
+        if service not in _http_clients:
+            _http_clients[service] = HttpClient(
+                max_retries=HTTP_MAX_RETRIES,
+                connect_timeout=HTTP_CONNECT_TIMEOUT,
+                read_timeout=HTTP_READ_TIMEOUT,
+            )
+        return _http_clients[service]
+
+def request_semaphore() -> asyncio.Semaphore:
+    """
+    The semaphore bounding the concurrent requests of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _request_semaphores:
+        _request_semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _request_semaphores[loop]
+
+def run_sync(coroutine):
+    """
+    Run the coroutine on the background event loop and wait for its result.
+    The coroutine sees the context variables of the caller (e.g. the metrics being collected).
+    Must not be called from a coroutine.
+    """
+    global _sync_loop
+
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name="upgraider-model-loop", daemon=True).start()
+
+    context = contextvars.copy_context()
+
+    async def run_in_caller_context():
+        for variable, value in context.items():
+            variable.set(value)
+        return await coroutine
+
+    return asyncio.run_coroutine_threadsafe(run_in_caller_context(), _sync_loop).result()
+
+async def close_http_sessions_async():
+    """
+    Close the connections opened from the running event loop. Call before the loop is closed.
+    """
+    for client in list(_http_clients.values()):
+        await client.close_async()
+
+@atexit.register
+def _close_sync_loop_sessions():
+    if _sync_loop is not None:
+        asyncio.run_coroutine_threadsafe(close_http_sessions_async(), _sync_loop).result(timeout=5)
+
+def _openai_retryable_error(e: "openai.error.OpenAIError") -> RetryableError:
+    """
+    The RetryableError to raise for a rate limited or transient openai error, None for other errors
+    """
+    import openai
+    transient = isinstance(e, (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain))
+    server_error = isinstance(e, openai.error.APIError) and (e.http_status is None or e.http_status >= 500)
+    if not transient and not server_error:
+        return None
+
+    return RetryableError(f"OpenAI request failed: {e}", retry_after=parse_retry_after((e.headers or {}).get("Retry-After")))
+
+def call_openai(create, **params):
+    """
+    Call an openai create method (e.g. openai.ChatCompletion.create) with timeouts, retrying rate limited
+    and transient failures. The openai library keeps its own keep-alive session per thread.
+    """
+    import openai
+    def send():
+        try:
+            return create(request_timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **params)
+        except openai.error.OpenAIError as e:
+            retryable_error = _openai_retryable_error(e)
+            if retryable_error is None:
+                raise
+            raise retryable_error from e
+
+    return get_http_client("openai").call(send)
+
+async def call_openai_async(acreate, **params):
+    """
+    Same as call_openai for an async openai create method (e.g. openai.ChatCompletion.acreate).
+    Requests reuse the pooled aiohttp session of the openai client.
+    """
+    import openai
+    client = get_http_client("openai")
+
+    async def send():
+        session = openai.aiosession.set(client.async_session())
+        try:
+            async with request_semaphore():
+                return await acreate(request_timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **params)
+        except openai.error.OpenAIError as e:
+            retryable_error = _openai_retryable_error(e)
+            if retryable_error is None:
+                raise
+            raise retryable_error from e
+        finally:
+            openai.aiosession.reset(session)
+
+    return await client.call_async(send)
+
+def set_response_cache_mode(mode: str):
+    global _response_cache_mode
+
+    if mode not in RESPONSE_CACHE_MODES:
+        raise ValueError(f"Invalid response cache mode {mode}, expected one of {RESPONSE_CACHE_MODES}")
+    _response_cache_mode = mode
+
+def get_response_cache() -> DiskCache:
+    global _response_cache
+
+    with _cache_lock:
+        if _response_cache is None:
+            _response_cache = DiskCache(os.path.join(CACHE_DIR, "responses.db"), max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+
+    return _response_cache
+
+def response_cache_key(endpoint: str, request: dict) -> str:
+    request_json = json.dumps(request, sort_keys=True)
+    return f"{endpoint}:{hashlib.sha256(request_json.encode('utf-8')).hexdigest()}"
+
+async def get_model_response_async(endpoint: str, request: dict, send_request) -> str:
+    """
+    Return the response text for the request sent to endpoint ("chat", or "gpt-4:<endpoint url>"), from the response cache
+    or by awaiting send_request(), depending on the response cache mode
+    """
+    if _response_cache_mode == "bypass":
+        return await send_model_request(send_request)
+
+    # the cache is sqlite, so it is read and written off the event loop
+    cache = await asyncio.to_thread(get_response_cache)
+    cache_key = response_cache_key(endpoint, request)
+
+    cached_response = await asyncio.to_thread(cache.get, cache_key)
+    if cached_response is not None:
+        count("response_cache_hits")
+        return cached_response.decode('utf-8')
+
+    if _response_cache_mode == "replay":
+        raise ResponseNotRecorded(f"No recorded response from {endpoint} for this request")
+
+    response_text = await send_model_request(send_request)
+    await asyncio.to_thread(cache.put, cache_key, response_text.encode('utf-8'))
+    return response_text
+
+async def send_model_request(send_request) -> str:
+    with span("model_call"):
+        response_text = await send_request()
+    count("model_requests")
+    return response_text
+
+def count_token_usage(response: dict, prompt_text: str, response_text: str):
+    """
+    Count the prompt and completion tokens of a model response, as reported by the endpoint or else as counted here.
+    Tokens are only counted here when metrics are collected and the endpoint did not report them.
+    """
+    if current_metrics() is None:
+        return
+
+    usage = response.get("usage") or {}
+    if "prompt_tokens" in usage:
+        count("prompt_tokens", usage["prompt_tokens"])
+    else:
+        count("prompt_tokens", count_tokens(prompt_text))
+    if "completion_tokens" in usage:
+        count("completion_tokens", usage["completion_tokens"])
+    else:
+        count("completion_tokens", count_tokens(response_text))
+
+async def wait_for_rate_limit_async(prompt_text: str, max_tokens: int):
+    """
+    Wait until a request with this prompt (and at most max_tokens completion tokens) fits in the rate limits
+    """
+    if _rate_limiter is not None:
+        await _rate_limiter.acquire_async(len(get_encoding().encode(prompt_text)) + max_tokens)
+
 def get_update_status(update_status: str) -> UpdateStatus:
     if update_status == "Update":
         return UpdateStatus.UPDATE
@@ -148,19 +410,127 @@ def parse_model_response(model_response: str) -> ModelResponse:
     return response
 
 
+def get_embedding_cache() -> DiskCache:
+    global _embedding_cache
+
+    with _cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = DiskCache(
+                os.path.join(CACHE_DIR, "embeddings.db"),
+                max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+                max_bytes=EMBEDDING_CACHE_MAX_BYTES,
+            )
+
+    return _embedding_cache
+
+def embedding_cache_key(text: str, model: str = EMBEDDING_MODEL) -> str:
+    return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
 def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> list[float]:
     """
         Returns the embedding for the supplied text.
+        Embeddings are served from the on-disk cache when this text was embedded before.
     """
+    return run_sync(get_embedding_async(text, model))
+
+async def get_embedding_async(text: str, model: str = EMBEDDING_MODEL) -> list[float]:
+    import openai
+    from upgraider.Database import encode_embedding, decode_embedding
+    # the cache is sqlite, so it is read and written off the event loop
+    cache = await asyncio.to_thread(get_embedding_cache)
+    cache_key = embedding_cache_key(text, model)
+
+    cached_embedding = await asyncio.to_thread(cache.get, cache_key)
+    if cached_embedding is not None:
+        count("embedding_cache_hits")
+        return decode_embedding(cached_embedding).tolist()
+
     openai.api_key = env['OPENAI_API_KEY']
 
     try:
-        result = openai.Embedding.create(model=model, input=text)
+        with span("embedding"):
+            result = await call_openai_async(openai.Embedding.acreate, model=model, input=text)
     except openai.error.InvalidRequestError as e:
         print(f"ERROR: {e}")
         return None
     
-    return result["data"][0]["embedding"]
+    count("embedding_requests")
+    count("embedding_tokens", result.get("usage", {}).get("total_tokens", 0))
+    embedding = result["data"][0]["embedding"]
+    await asyncio.to_thread(cache.put, cache_key, encode_embedding(embedding))
+
+    return embedding
+
+
+def batch_by_token_count(
+    texts: list[str],
+    max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+    max_inputs: int = EMBEDDING_BATCH_MAX_INPUTS,
+) -> list[list[str]]:
+    """
+    Split the texts into batches that each stay within max_tokens tokens and max_inputs texts.
+    Texts that are too long to be embedded at all are put in a batch of their own.
+    """
+    batches = []
+    current_batch = []
+    current_tokens = 0
+
+    for text in texts:
+        num_tokens = len(get_encoding().encode(text))
+
+        if num_tokens > EMBEDDING_MAX_INPUT_TOKENS:
+            batches.append([text])
+            continue
+
+        if current_batch and (current_tokens + num_tokens > max_tokens or len(current_batch) >= max_inputs):
+            batches.append(current_batch)
+            current_batch = []
+            current_tokens = 0
+
+        current_batch.append(text)
+        current_tokens += num_tokens
+
+    if current_batch:
+        batches.append(current_batch)
+
+    return batches
+
+def get_embeddings(texts: list[str], model: str = EMBEDDING_MODEL) -> list[list[float]]:
+    """
+        Returns the embeddings for the supplied texts, in the same order.
+        Texts that are not in the embedding cache are embedded with as few multi-input requests as possible.
+    """
+    import openai
+    from upgraider.Database import encode_embedding, decode_embedding
+    cache = get_embedding_cache()
+    embeddings = {}
+
+    for text in texts:
+        if text not in embeddings:
+            cached_embedding = cache.get(embedding_cache_key(text, model))
+            embeddings[text] = decode_embedding(cached_embedding).tolist() if cached_embedding is not None else None
+
+    missing_texts = [text for text, embedding in embeddings.items() if embedding is None]
+
+    if missing_texts:
+        openai.api_key = env['OPENAI_API_KEY']
+
+    for batch in batch_by_token_count(missing_texts):
+        try:
+            result = call_openai(openai.Embedding.create, model=model, input=batch)
+        except openai.error.InvalidRequestError as e:
+            # embed the texts of the rejected batch one by one so that only the offending ones are lost
+            print(f"ERROR: {e}")
+            for text in batch:
+                embeddings[text] = get_embedding(text, model)
+            continue
+
+        for item in result["data"]:
+            text = batch[item["index"]]
+            embeddings[text] = item["embedding"]
+            cache.put(embedding_cache_key(text, model), encode_embedding(item["embedding"]))
+
+    return [embeddings[text] for text in texts]
 
 
 def vector_similarity(x: list[float], y: list[float]) -> float:
@@ -173,49 +543,79 @@ def vector_similarity(x: list[float], y: list[float]) -> float:
         return 0.0
     return np.dot(np.array(x), np.array(y))
 
+def reference_index(sections: list[DeprecationWarning], index: EmbeddingIndex = None) -> EmbeddingIndex:
+    """
+    The index to retrieve references from: index if given, otherwise an index built from sections
+    """
+    from upgraider.Database import load_embeddings
+    if index is None:
+        index = EmbeddingIndex.from_embeddings(load_embeddings(sections), sections)
+    return index
+
 def get_reference_list(
     original_code: str,
     sections: list[DeprecationWarning],
     threshold: float = 0.0,
+    index: EmbeddingIndex = None,
+    max_tokens: int = MAX_REFERENCE_TOKENS,
 ):
+    index = reference_index(sections, index)
+
+    if len(index) == 0:
+        return [] # nothing to retrieve, so no need to embed the query
+
+    query_embedding = get_embedding(original_code)
+    with span("retrieval"):
+        return select_references(index, query_embedding, threshold, max_tokens)
+
+def section_num_tokens(section) -> int:
+    """
+    Number of tokens of the reference text of the section, as stored at ingestion time when available
+    """
+    num_tokens = getattr(section, "num_tokens", None)
+    if num_tokens is None:
+        num_tokens = count_tokens(reference_text(section.content))
+    return num_tokens
+
+def select_references(
+    index: EmbeddingIndex,
+    query_embedding: list[float],
+    threshold: float = 0.0,
+    max_tokens: int = MAX_REFERENCE_TOKENS,
+) -> list[str]:
+    """
+    The most similar sections to the query embedding, formatted as a numbered list, until they fill max_tokens tokens.
+    The section that does not fit anymore is truncated to the remaining tokens.
+    """
     chosen_sections = []
-    chosen_sections_len = 0
-    ref_count = 0
+    remaining_tokens = max_tokens
 
-    context_embeddings = load_embeddings(sections)
-        
-    most_relevant_document_sections = order_document_sections_by_query_similarity(
-        original_code, context_embeddings, threshold
+    most_relevant_document_sections = iter_most_similar_sections(
+        index, query_embedding, threshold
     )
 
     for similarity, section_index in most_relevant_document_sections:
-
-        if chosen_sections_len > MAX_SECTION_LEN:
-            break
-
         # Add sections as context, until we run out of space.
-        section_content = [
-                section for section in sections if section.id == section_index][0].content
-
-        section_tokens = section_content.split(" ")
+        section = index.get_section(section_index)
 
-        if len(section_tokens) < 3:
+        if len(section.content.split(" ")) < 3:
             continue # skip one or two word references
 
-        len_if_added = chosen_sections_len + len(section_tokens) + separator_len
-
-        # if current section will exceed max length, truncate it
-        if len_if_added > MAX_SECTION_LEN:
-            section_content = " ".join(
-                section_tokens[: MAX_SECTION_LEN - chosen_sections_len]
-            )
-
-        chosen_sections_len = len_if_added
-        ref_count += 1
-
-        chosen_sections.append(
-            "\n" + str(ref_count) + ". " + section_content.replace("\n", " ")
-        )
+        prefix = "\n" + str(len(chosen_sections) + 1) + ". "
+        available_tokens = remaining_tokens - count_tokens(prefix)
+        section_tokens = section_num_tokens(section)
+
+        if section_tokens <= available_tokens:
+            chosen_sections.append(prefix + reference_text(section.content))
+            remaining_tokens = available_tokens - section_tokens
+            continue
+
+        # the first section that does not fit is truncated, unless too little of it would be left
+        if available_tokens >= MIN_TRUNCATED_REFERENCE_TOKENS:
+            encoding = get_encoding()
+            truncated_content = encoding.decode(encoding.encode(reference_text(section.content))[:available_tokens])
+            chosen_sections.append(prefix + truncated_content)
+        break
     
     return chosen_sections
 
@@ -234,56 +634,131 @@ def get_readycontext_refs_list(
     
     return ready_context
 
+def iter_most_similar_sections(
+    index: EmbeddingIndex,
+    query_embedding: list[float],
+    threshold: float = None,
+):
+    """
+    Lazily yield (similarity, section id) pairs in descending order of similarity.
+
+    The index is asked for the top REFERENCE_CANDIDATES sections first, and for twice as many
+    each time the caller consumes all of them, so usually only a small prefix of the corpus is sorted.
+    """
+    if query_embedding is None:
+        return
+
+    k = REFERENCE_CANDIDATES
+    seen = set()
+
+    while True:
+        results = index.search(query_embedding, k=k, threshold=threshold)
+
+        for similarity, section_id in results:
+            if section_id not in seen:
+                seen.add(section_id)
+                yield similarity, section_id
+
+        if len(results) < k:
+            return
+
+        k *= 2
+
 def order_document_sections_by_query_similarity(
     query: str, 
-    contexts: dict[(int, int), np.array],
-    threshold: float = None
-) -> list[(float, (int, int))]:
+    index: EmbeddingIndex,
+    threshold: float = None,
+    k: int = None,
+) -> list[(float, int)]:
     """
     Find the query embedding for the supplied query, and compare it against all of the pre-calculated document embeddings
     to find the most relevant sections.
 
-    Return the list of document sections, sorted by relevance in descending order.
+    Return the list of document sections (at most k if set), sorted by relevance in descending order.
     """
     query_embedding = get_embedding(query)
 
     if query_embedding is None:
         return []
 
-    document_similarities = sorted(
-        [
-            (vector_similarity(query_embedding, doc_embedding), doc_index)
-            for doc_index, doc_embedding in contexts.items()
-        ],
-        reverse=True,
-    )
-
-    if threshold:
-        document_similarities = [sim for sim in document_similarities if sim[0] > threshold]
-
-
-    return document_similarities
+    return index.search(query_embedding, k=k, threshold=threshold)
 
 def construct_fixing_prompt(
     original_code: str,
     sections: list[DeprecationWarning],
     ready_context: str = None,
     threshold: float = None,
+    index: EmbeddingIndex = None,
+    model: str = "gpt-3.5",
 ):   
     # print("constructing prompt...")
 
     if not ready_context:
-        references = get_reference_list(original_code=original_code, sections=sections, threshold=threshold)
+        with span("prompt"):
+            max_tokens = reference_token_budget(original_code, model)
+        references = get_reference_list(original_code=original_code, sections=sections, threshold=threshold, index=index, max_tokens=max_tokens)
     else:
        references = get_readycontext_refs_list(ready_context=ready_context)
 
-    script_dir = os.path.dirname(__file__)
-    with open(os.path.join(script_dir, "resources/chat_template.txt"), "r") as file:
-        chat_template = Template(file.read())
-        prompt_text = chat_template.substitute(original_code=original_code, references="".join(references))
+    with span("prompt"):
+        return fill_fixing_template(original_code, references)
+
+async def construct_fixing_prompt_async(
+    original_code: str,
+    sections: list[DeprecationWarning],
+    ready_context: str = None,
+    threshold: float = None,
+    index: EmbeddingIndex = None,
+    model: str = "gpt-3.5",
+):
+    if not ready_context:
+        # building the index and searching it are cpu bound, so they run off the event loop
+        if index is None:
+            index = await asyncio.to_thread(reference_index, sections)
+        references = []
+        if len(index) > 0:
+            query_embedding = await get_embedding_async(original_code)
+            with span("prompt"):
+                max_tokens = reference_token_budget(original_code, model)
+            with span("retrieval"):
+                references = await asyncio.to_thread(select_references, index, query_embedding, threshold, max_tokens)
+    else:
+        references = get_readycontext_refs_list(ready_context=ready_context)
+
+    with span("prompt"):
+        return fill_fixing_template(original_code, references)
+
+def get_chat_template() -> Template:
+    global _chat_template
+
+    if _chat_template is None:
+        script_dir = os.path.dirname(__file__)
+        with open(os.path.join(script_dir, "resources/chat_template.txt"), "r") as file:
+            _chat_template = Template(file.read())
+
+    return _chat_template
+
+def fill_fixing_template(original_code: str, references: list[str]):
+    prompt_text = get_chat_template().substitute(original_code=original_code, references="".join(references))
 
     return prompt_text, len(references)
 
+def reference_token_budget(original_code: str, model: str = "gpt-3.5") -> int:
+    """
+    Number of tokens the references can use in the prompt for original_code
+    """
+    prompt_text, _ = fill_fixing_template(original_code, [])
+    prompt_tokens = count_tokens(prompt_text)
+
+    if model == "gpt-3.5":
+        prompt_tokens += count_tokens(SYSTEM_MESSAGE) + 2 * CHAT_MESSAGE_OVERHEAD_TOKENS
+        response_tokens = GPT_3_5_TURBO_API_PARAMS["max_tokens"]
+    else:
+        response_tokens = GPT4_MAX_TOKENS
+
+    available_tokens = MODEL_CONTEXT_WINDOWS[model] - prompt_tokens - response_tokens
+    return max(0, min(MAX_REFERENCE_TOKENS, available_tokens))
+
 def display_conversation(messages: list[dict[str, str]]):
     for message in messages:
         print(message["role"] + ": " + message["content"] + '\n')
@@ -295,27 +770,50 @@ def fix_suggested_code(
     model: str = "gpt-3.5",
     threshold: float = None,
     ready_context: str = None,
+    library: Library = None,
 ) :
-    
+    return run_sync(fix_suggested_code_async(query, show_prompt, db_source, model, threshold, ready_context, library))
+
+async def fix_suggested_code_async(
+    query: str,
+    show_prompt: bool = False,
+    db_source: str = DBSource.documentation,
+    model: str = "gpt-3.5",
+    threshold: float = None,
+    ready_context: str = None,
+    library: Library = None,
+) :
+    """
+    Same as fix_suggested_code, awaitable from an event loop. Any number of snippets can be fixed
+    concurrently; at most MAX_CONCURRENT_REQUESTS requests per loop are sent at the same time.
+    If library is given, references only come from its release notes between its base and current version.
+    """
+    from upgraider.Database import get_embedding_index
+
     sections = None
+    index = None
     if not ready_context:
         if db_source == DBSource.documentation:
-            sections = get_embedded_doc_sections()
+            # the index holds the sections, so they are only loaded from the DB once per process
+            if library is not None:
+                index = await asyncio.to_thread(get_embedding_index, library.name, library.baseversion, library.currentversion)
+            else:
+                index = await asyncio.to_thread(get_embedding_index)
         elif db_source == DBSource.modelonly:
             sections = []
         else:
             raise ValueError(f"Invalid db_source {db_source}")
     
-    prompt_text, ref_count = construct_fixing_prompt(original_code=query, sections=sections, ready_context=ready_context, threshold=threshold)
+    prompt_text, ref_count = await construct_fixing_prompt_async(original_code=query, sections=sections, ready_context=ready_context, threshold=threshold, index=index, model=model)
         
     if model == "gpt-3.5": 
         prompt = [
-            {"role": "system", "content":"You are a smart code reviewer who can spot code that uses a non-existent or deprecated API."},
+            {"role": "system", "content": SYSTEM_MESSAGE},
             {"role": "user", "content": prompt_text}
         ]
-        model_response, parsed_response = fix_suggested_code_chat(prompt)    
+        model_response, parsed_response = await fix_suggested_code_chat_async(prompt)
     elif model == "gpt-4":
-        model_response, parsed_response = fix_suggested_code_completion(prompt_text)
+        model_response, parsed_response = await fix_suggested_code_completion_async(prompt_text)
     
     return prompt_text, model_response, parsed_response, ref_count
 
@@ -323,32 +821,59 @@ def fix_suggested_code(
     
 def fix_suggested_code_chat(
     prompt: list[str]
+) :
+    return run_sync(fix_suggested_code_chat_async(prompt))
+
+async def fix_suggested_code_chat_async(
+    prompt: list[str]
 ) :
     # print("Fixing code with chat API....")
 
-    openai.api_key = env['OPENAI_API_KEY']
-   
-    response = openai.ChatCompletion.create(messages=prompt, **GPT_3_5_TURBO_API_PARAMS)
-    response_text = response['choices'][0]['message']['content']
+    async def send_request() -> str:
+        import openai
+        openai.api_key = env['OPENAI_API_KEY']
+        await wait_for_rate_limit_async("".join(message["content"] for message in prompt), GPT_3_5_TURBO_API_PARAMS["max_tokens"])
+
+        response = await call_openai_async(openai.ChatCompletion.acreate, messages=prompt, **GPT_3_5_TURBO_API_PARAMS)
+        response_text = response['choices'][0]['message']['content']
+        count_token_usage(response, "".join(message["content"] for message in prompt), response_text)
+        return response_text
+
+    response_text = await get_model_response_async("chat", {"messages": prompt, **GPT_3_5_TURBO_API_PARAMS}, send_request)
     
-    return response_text, parse_model_response(response_text)
+    with span("parsing"):
+        return response_text, parse_model_response(response_text)
 
 def fix_suggested_code_completion(
     prompt: str
 ) -> str:
-    gpt4_endpoint = env['GPT4_ENDPOINT']
-    auth_headers = env['GPT4_AUTH_HEADERS']
-    headers = {
-      "Content-Type": "application/json",
-       **json.loads(auth_headers),
-    }
+    return run_sync(fix_suggested_code_completion_async(prompt))
+
+async def fix_suggested_code_completion_async(
+    prompt: str
+) -> str:
     json_data = {
         'prompt': prompt,
         'temperature': 0,
         'best_of': 1,
-        'max_tokens': 300
+        'max_tokens': GPT4_MAX_TOKENS
     }
 
-    response = requests.post(gpt4_endpoint, headers=headers, data=json.dumps(json_data)).json()
-    response_text = response['choices'][0]['text'].strip(" \n")
-    return response_text, parse_model_response(response_text)
+    async def send_request() -> str:
+        gpt4_endpoint = env['GPT4_ENDPOINT']
+        auth_headers = env['GPT4_AUTH_HEADERS']
+        headers = {
+          "Content-Type": "application/json",
+           **json.loads(auth_headers),
+        }
+
+        await wait_for_rate_limit_async(prompt, GPT4_MAX_TOKENS)
+        response = await get_http_client("gpt-4").post_json_async(gpt4_endpoint, json_data, headers=headers, semaphore=request_semaphore())
+        response_text = response['choices'][0]['text'].strip(" \n")
+        count_token_usage(response, prompt, response_text)
+        return response_text
+
+    # the request does not name the deployment, so responses are cached per endpoint url
+    response_text = await get_model_response_async(f"gpt-4:{env.get('GPT4_ENDPOINT', '')}", json_data, send_request)
+    with span("parsing"):
+        return response_text, parse_model_response(response_text)
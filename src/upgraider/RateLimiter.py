@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket holding at most `capacity` units, refilled continuously at `capacity` units per minute.
+    """
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.available = capacity
+        self.last_refill = time.monotonic()
+
+    def refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.available = min(self.capacity, self.available + elapsed * self.capacity / 60)
+        self.last_refill = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Seconds until `amount` units are available (0 if they already are)
+        """
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0) * 60 / self.capacity
+
+
+class RateLimiter:
+    """
+    Limits model requests to a requests-per-minute and a tokens-per-minute budget.
+    Either budget can be None to leave it unlimited. Can be shared by several threads.
+    """
+
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+
+    def try_acquire(self, num_tokens: int = 0) -> float:
+        """
+        Consume one request using num_tokens tokens if it fits in the budgets and return 0,
+        otherwise return the number of seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            buckets = [(bucket, amount) for bucket, amount in [(self.requests, 1), (self.tokens, num_tokens)] if bucket is not None]
+
+            for bucket, _ in buckets:
+                bucket.refill(now)
+
+            wait = max([bucket.wait_time(amount) for bucket, amount in buckets], default=0)
+            if wait == 0:
+                for bucket, amount in buckets:
+                    bucket.available -= min(amount, bucket.capacity)
+            return wait
+
+    def acquire(self, num_tokens: int = 0):
+        """
+        Block until one request using num_tokens tokens fits in the budgets, then consume it.
+        Requests that use more tokens than the per-minute budget wait for a full bucket.
+        """
+        while (wait := self.try_acquire(num_tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, num_tokens: int = 0):
+        """
+        Same as acquire, but waits without blocking the event loop
+        """
+        while (wait := self.try_acquire(num_tokens)) > 0:
+            await asyncio.sleep(wait)
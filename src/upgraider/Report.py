@@ -1,6 +1,6 @@
 from enum import Enum
 from apiexploration.Library import Library, FunctionDiff
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from dataclasses_json import dataclass_json
 
 class DBSource(Enum):
@@ -22,12 +22,17 @@ class RunProblem:
     name: str
     element_name: str
     target_obj: str | None = None
+    # where and how the problem was reported; not part of what makes two problems the same
+    message: str | None = field(default=None, compare=False)
+    filename: str | None = field(default=None, compare=False)
+    lineno: int | None = field(default=None, compare=False)
  
 @dataclass
 class RunResult:
     problem_free: bool # true if no error or warning, false otherwise
-    problem: RunProblem = None
+    problem: RunProblem = None # the error if the run failed, otherwise the first warning
     msg: str = None
+    problems: list[RunProblem] = None # every warning and error of the run, in the order they happened
 
 class UpdateStatus(Enum):
     UPDATE = "UPDATE"
@@ -58,6 +63,18 @@ class ModelResponse:
     updated_code: str
     reason: str
 
+@dataclass_json
+@dataclass
+class Metrics:
+    timings: dict[str, float] = field(default_factory=dict) # seconds spent in each stage
+    counters: dict[str, int] = field(default_factory=dict) # e.g. prompt and completion tokens
+
+    def add(self, other: "Metrics"):
+        for stage, seconds in other.timings.items():
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
 @dataclass_json
 @dataclass
 class SnippetReport:
@@ -72,6 +89,8 @@ class SnippetReport:
     modified_run: RunResult
     fix_status: FixStatus
     diff: str = None
+    metrics: Metrics = None
+    error: str = None # set if fixing the snippet failed before a report could be made
 
 @dataclass_json
 @dataclass
@@ -86,4 +105,5 @@ class Report:
     snippets: list[SnippetReport] = None
     percent_updated: float = None
     percent_updated_w_refs: float = None
-    percent_fixed: float = None
\ No newline at end of file
+    percent_fixed: float = None
+    metrics: Metrics = None # sum of the metrics of the snippets, and the wall time of the whole run
\ No newline at end of file
@@ -0,0 +1,85 @@
+import os
+from collections.abc import Mapping
+from typing import NamedTuple
+import numpy as np
+
+
+class Section(NamedTuple):
+    """
+    Read-only documentation section, as needed to use it as a reference
+    """
+    id: int
+    content: str
+    num_tokens: int
+
+
+class SectionTable(Mapping):
+    """
+    Map from section id to Section, stored as flat arrays: the sorted section ids, their token counts,
+    and the UTF-8 text of all sections concatenated, with the offset at which each one starts.
+
+    Saved to disk as .npy files that are memory-mapped when loaded, so opening the table takes the same
+    time for any number of sections, and only the sections that are looked up are read and decoded.
+    """
+
+    ARRAYS = ["ids", "offsets", "num_tokens", "texts"]
+
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray, num_tokens: np.ndarray, texts: np.ndarray):
+        if len(offsets) != len(ids) + 1 or len(num_tokens) != len(ids):
+            raise ValueError(f"Got {len(offsets)} offsets and {len(num_tokens)} token counts for {len(ids)} sections")
+
+        self.ids = ids
+        self.offsets = offsets
+        self.num_tokens = num_tokens
+        self.texts = texts
+
+    @classmethod
+    def from_sections(cls, sections: list) -> "SectionTable":
+        """
+        Build the table from sections with an id, a content and a token count (None if unknown)
+        """
+        sections = sorted(sections, key=lambda section: section.id)
+        encoded = [(section.content or "").encode("utf-8") for section in sections]
+
+        ids = np.array([section.id for section in sections], dtype=np.int64)
+        offsets = np.zeros(len(sections) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+        num_tokens = np.array(
+            [section.num_tokens if section.num_tokens is not None else -1 for section in sections], dtype=np.int32
+        )
+        texts = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(ids, offsets, num_tokens, texts)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path: str) -> "SectionTable":
+        return cls(*[np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in cls.ARRAYS])
+
+    def _row(self, section_id: int) -> int:
+        row = int(np.searchsorted(self.ids, section_id))
+        if row == len(self.ids) or self.ids[row] != section_id:
+            raise KeyError(section_id)
+        return row
+
+    def __getitem__(self, section_id: int) -> Section:
+        row = self._row(section_id)
+        content = self.texts[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+        num_tokens = int(self.num_tokens[row])
+        return Section(section_id, content, num_tokens if num_tokens >= 0 else None)
+
+    def __contains__(self, section_id) -> bool:
+        try:
+            self._row(section_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.ids)
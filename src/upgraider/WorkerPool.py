@@ -0,0 +1,158 @@
+import atexit
+import json
+import os
+import subprocess
+import threading
+
+script_dir = os.path.dirname(__file__)
+
+def snippet_env() -> dict:
+    """
+    Environment of the interpreters that run snippets. BLAS libraries start one thread (each with its own
+    buffers) per core when they are imported; one thread is enough for a snippet and keeps parallel runs small.
+    """
+    return {"OPENBLAS_NUM_THREADS": "1", **os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+
+
+class SnippetWorker:
+    """
+    A warm fork_server.py process running in a venv, with the library already imported.
+    Runs one snippet at a time. Its replies come through a pipe of their own, so that the worker
+    and its snippets share the stdout of this process, like snippets run in a new interpreter.
+    """
+
+    def __init__(self, python: str, module_name: str, cpu_seconds: int, memory_mb: int):
+        replies_read, replies_write = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                [python, os.path.join(script_dir, "fork_server.py"), str(cpu_seconds), str(memory_mb), module_name, str(replies_write)],
+                stdin=subprocess.PIPE,
+                pass_fds=(replies_write,),
+                env=snippet_env(),
+                text=True,
+            )
+        except BaseException:
+            os.close(replies_read)
+            raise
+        finally:
+            os.close(replies_write)
+        self.replies = os.fdopen(replies_read, 'r')
+        self._read_reply()  # wait until the library is imported
+
+    def _read_reply(self) -> dict:
+        line = self.replies.readline()
+        if not line:
+            raise RuntimeError(f"Snippet worker exited with code {self.process.wait()}")
+        return json.loads(line)
+
+    def run(self, file: str, cwd: str, stderr_file: str, problems_file: str, timeout: float) -> (int, bool):
+        """
+        Run the snippet in cwd, writing its stderr to stderr_file and its problem records to problems_file.
+        Return its exit code (None if it timed out) and whether it timed out.
+        """
+        request = {"file": file, "cwd": cwd, "stderr": stderr_file, "problems": problems_file, "timeout": timeout}
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+
+        reply = self._read_reply()
+        return reply["returncode"], reply["timed_out"]
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        finally:
+            self.replies.close()
+
+
+class WorkerPool:
+    """
+    Pool of up to max_workers warm workers for one venv. Workers are started on demand
+    and reused for the following snippets.
+    """
+
+    def __init__(self, python: str, module_name: str, max_workers: int, cpu_seconds: int, memory_mb: int):
+        self.python = python
+        self.module_name = module_name
+        self.max_workers = max_workers
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+
+        self._idle = []
+        self._num_workers = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self) -> SnippetWorker:
+        with self._condition:
+            while not self._idle and self._num_workers >= self.max_workers:
+                self._condition.wait()
+
+            if self._idle:
+                return self._idle.pop()
+
+            self._num_workers += 1
+
+        try:
+            return SnippetWorker(self.python, self.module_name, self.cpu_seconds, self.memory_mb)
+        except Exception:
+            self._discard()
+            raise
+
+    def release(self, worker: SnippetWorker):
+        """
+        Give the worker back to the pool, or get rid of it if it died
+        """
+        if not worker.alive() or self._closed:
+            worker.close()
+            self._discard()
+            return
+
+        with self._condition:
+            self._idle.append(worker)
+            self._condition.notify()
+
+    def _discard(self):
+        with self._condition:
+            self._num_workers -= 1
+            self._condition.notify()
+
+    def run(self, file: str, cwd: str, stderr_file: str, problems_file: str, timeout: float) -> (int, bool):
+        worker = self.acquire()
+        try:
+            return worker.run(file, cwd, stderr_file, problems_file, timeout)
+        finally:
+            self.release(worker)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for worker in idle:
+            worker.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_worker_pool(python: str, module_name: str, max_workers: int, cpu_seconds: int, memory_mb: int) -> WorkerPool:
+    """
+    Return the pool of the given venv python, creating it the first time
+    """
+    with _pools_lock:
+        if python not in _pools:
+            _pools[python] = WorkerPool(python, module_name, max_workers, cpu_seconds, memory_mb)
+        return _pools[python]
+
+@atexit.register
+def close_worker_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,36 @@
+import argparse
+import time
+from upgraider.Database import get_embedded_doc_sections, get_release_notes, partition_sections, build_sharded_index, save_snapshot, embedding_index_path
+from upgraider.EmbeddingIndex import IVFIndex, ShardedIndex
+
+def build_index(partitions: dict, kind: str, num_lists: int = None, nprobe: int = 8) -> ShardedIndex:
+    """
+    Index with one shard per (library, version) partition. With kind "ivf", shards too small
+    to have more than nprobe lists stay exact, since a query would scan all of them anyway.
+    """
+    index = build_sharded_index(partitions)
+    if kind == IVFIndex.KIND:
+        for key, shard in index.shards.items():
+            shard_lists = num_lists if num_lists is not None else int(len(shard) ** 0.5)
+            if shard_lists > nprobe:
+                index.shards[key] = IVFIndex.build(shard, num_lists=shard_lists, nprobe=nprobe)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the embedding index of the release notes database and save it with the sections to a snapshot')
+    parser.add_argument('--output', type=str, help='folder to save the snapshot to', default=embedding_index_path)
+    parser.add_argument('--kind', type=str, choices=["ivf", "exact"], help='approximate (ivf) or exact index', default="ivf")
+    parser.add_argument('--lists', type=int, help='number of clusters of each ivf shard (default: square root of the number of sections of the shard)', default=None)
+    parser.add_argument('--nprobe', type=int, help='number of clusters scanned per query', default=8)
+
+    args = parser.parse_args()
+
+    sections = get_embedded_doc_sections()
+    start = time.perf_counter()
+    index = build_index(partition_sections(sections, get_release_notes()), args.kind, args.lists, args.nprobe)
+    save_snapshot(index, sections, args.output)
+
+    print(f"Saved {args.kind} index of {len(index)} sections in {len(index.shards)} shards to {args.output} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Client of the fix server (see fix_server.py).
+
+Only depends on the standard library, so that short-lived tools such as update_brushes_code.py
+can ask the server for a fix without paying for the imports of upgraider.Model.
+"""
+import json
+import os
+import socket
+
+FIX_SOCKET = os.environ.get(
+    "UPGRAIDER_FIX_SOCKET",
+    os.path.join(os.path.expanduser("~"), ".cache", "upgraider", "fix.sock"),
+)
+# seconds to wait for the reply of the server; a fix can take several model calls and retries
+FIX_TIMEOUT = float(os.environ.get("UPGRAIDER_FIX_TIMEOUT", 300))
+
+def fix_reply(parsed_response, ref_count: int) -> dict:
+    """
+    The reply of the server for the ModelResponse of a fix
+    """
+    return {
+        "update_status": parsed_response.update_status.value,
+        "references": parsed_response.references,
+        "updated_code": parsed_response.updated_code,
+        "reason": parsed_response.reason,
+        "ref_count": ref_count,
+    }
+
+class FixServerError(RuntimeError):
+    """
+    The fix server received the request but could not fix the code
+    """
+
+def request_fix(code: str, model: str = "gpt-4", library: dict = None, socket_path: str = FIX_SOCKET, timeout: float = FIX_TIMEOUT) -> dict:
+    """
+    Ask the fix server listening on socket_path to fix the code, optionally with the references of
+    library (a dict with its name, baseversion and currentversion). Returns the reply (see fix_reply),
+    or None if no server is running.
+    Raises FixServerError if the server failed to fix the code, and OSError (e.g. TimeoutError after
+    timeout seconds, or ConnectionError for an empty or malformed reply) if talking to the server failed.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        try:
+            client.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        request = {"code": code, "model": model, "library": library}
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        client.shutdown(socket.SHUT_WR)
+
+        with client.makefile('r', encoding="utf-8") as replies:
+            line = replies.readline()
+    finally:
+        client.close()
+
+    if not line:
+        raise ConnectionError("Fix server closed the connection without replying")
+    try:
+        reply = json.loads(line)
+    except ValueError as e:
+        raise ConnectionError(f"Fix server sent a malformed reply: {e}") from e
+    if not isinstance(reply, dict):
+        raise ConnectionError(f"Fix server sent a malformed reply: {line[:100]!r}")
+
+    if "error" in reply:
+        raise FixServerError(f"Fix server failed: {reply['error']}")
+    return reply
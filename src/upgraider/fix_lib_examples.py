@@ -1,16 +1,23 @@
 
 import argparse
-from upgraider.Report import Report, SnippetReport, UpdateStatus, RunResult, FixStatus
+from upgraider.Report import Report, SnippetReport, ModelResponse, UpdateStatus, RunResult, FixStatus, Metrics
+from upgraider.instrumentation import collect_metrics, span
 from upgraider.run_code import run_code
-from upgraider.Model import fix_suggested_code 
+from upgraider.Model import fix_suggested_code, set_rate_limits, set_response_cache_mode, RESPONSE_CACHE_MODES
 import os
 import json
 import difflib
 from apiexploration.Library import Library
 from enum import Enum
 import ast
-from collections import namedtuple, defaultdict
 import time
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# defaults for the number of snippets fixed at once and the rate limits of the fixing model
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_MINUTE = 20
+DEFAULT_TOKENS_PER_MINUTE = 40_000
 
 class ResultType(Enum):
     PROMPT = 1
@@ -111,6 +118,24 @@ def fix_example(library: Library,
         db_source: str, 
         model: str = 'gpt3-5',
         threshold:float = None):
+    """
+    Fix the example and report the time spent and the tokens used in each stage in the metrics of its report
+    """
+    with collect_metrics() as metrics:
+        with span("total"):
+            snippet_results = _fix_example(library, example_file, examples_path, requirements_file, output_dir, db_source, model, threshold)
+
+    snippet_results.metrics = metrics
+    return snippet_results
+
+def _fix_example(library: Library, 
+        example_file: str, 
+        examples_path: str, 
+        requirements_file: str, 
+        output_dir: str, 
+        db_source: str, 
+        model: str,
+        threshold:float):
 
     example_file_path = os.path.join(examples_path, example_file)
 
@@ -118,9 +143,10 @@ def fix_example(library: Library,
     with open(example_file_path, 'r') as f:
         original_code = f.read()
 
-    original_code_result = run_code(library, example_file_path, requirements_file)
+    with span("run_original"):
+        original_code_result = run_code(library, example_file_path, requirements_file)
 
-    prompt_text, model_response, parsed_response, ref_count = fix_suggested_code(original_code, show_prompt=False, db_source=db_source, model=model, threshold=threshold)
+    prompt_text, model_response, parsed_response, ref_count = fix_suggested_code(original_code, show_prompt=False, db_source=db_source, model=model, threshold=threshold, library=library)
 
     print("Writing prompt to file...")
     prompt_file = _write_result(prompt_text, ResultType.PROMPT, output_dir, example_file)
@@ -145,7 +171,8 @@ def fix_example(library: Library,
             with open(updated_code_file, 'w') as f:
                 f.write(updated_code)
 
-            final_code_result = run_code(library, updated_code_file, requirements_file)
+            with span("run_modified"):
+                final_code_result = run_code(library, updated_code_file, requirements_file)
             diff = _unidiff(original_code, updated_code)
 
     snippet_results = SnippetReport(
@@ -165,11 +192,31 @@ def fix_example(library: Library,
     return snippet_results
 
 
-def fix_examples(library: Library, output_dir: str, db_source: str, model:str, threshold: float = None):
+def _failed_snippet_report(example_file: str, error: Exception) -> SnippetReport:
+    return SnippetReport(
+        original_file=example_file,
+        api=os.path.splitext(example_file)[0],
+        prompt_file=None,
+        original_run=None,
+        model_response=ModelResponse(update_status=UpdateStatus.NO_RESPONSE, references=None, updated_code=None, reason=None),
+        model_reponse_file=None,
+        num_references=0,
+        modified_file=None,
+        modified_run=None,
+        fix_status=FixStatus.NOT_FIXED,
+        error=f"{type(error).__name__}: {error}",
+    )
+
+def fix_examples(library: Library, output_dir: str, db_source: str, model:str, threshold: float = None, concurrency: int = DEFAULT_CONCURRENCY):
+    """
+    Fix all examples of the library, up to `concurrency` at a time. Requests to the model
+    are throttled by the rate limits of upgraider.Model (see set_rate_limits).
+    """
     print(f"=== Fixing examples for {library.name} with model {model}")
 
     report = Report(library)
     snippets = {}
+    start_time = time.perf_counter()
     examples_path = os.path.join(library.path, "examples")
 
     if os.path.exists(examples_path):
@@ -178,17 +225,25 @@ def fix_examples(library: Library, output_dir: str, db_source: str, model:str, t
         if not os.path.exists(requirements_file):
             requirements_file = None
 
-        for example_file in os.listdir(examples_path):
-            if example_file.startswith('.'):
-                continue
+        example_files = [example_file for example_file in os.listdir(examples_path) if not example_file.startswith('.')]
 
-            snippet_results = fix_example(library=library, example_file=example_file, examples_path=examples_path, requirements_file=requirements_file, output_dir=output_dir, db_source=db_source, model=model, threshold=threshold)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                example_file: executor.submit(fix_example, library=library, example_file=example_file, examples_path=examples_path, requirements_file=requirements_file, output_dir=output_dir, db_source=db_source, model=model, threshold=threshold)
+                for example_file in example_files
+            }
 
-            print(f"Finished fixing {example_file}...")
-            snippets[example_file] = snippet_results
+            for example_file, future in futures.items():
+                try:
+                    snippets[example_file] = future.result()
+                except Exception as e:
+                    # e.g. a response missing in replay mode, or an open circuit; the other snippets are still reported
+                    print(f"ERROR: could not fix {example_file}: {e!r}")
+                    snippets[example_file] = _failed_snippet_report(example_file, e)
+                print(f"Finished fixing {example_file}...")
 
-            # wait 30 seconds between each example
-            time.sleep(30)
+    # snippets are reported in file name order, regardless of when they finished
+    snippets = dict(sorted(snippets.items()))
 
     report.snippets = snippets
     report.num_snippets = len(snippets)
@@ -198,6 +253,12 @@ def fix_examples(library: Library, output_dir: str, db_source: str, model:str, t
     report.num_updated_w_refs = len([s for s in snippets.values() if s.model_response.update_status == UpdateStatus.UPDATE and s.model_response.references is not None and 'No references used' not in s.model_response.references])
     report.num_apis = len(set([s.api for s in snippets.values()]))
 
+    report.metrics = Metrics()
+    for snippet in snippets.values():
+        if snippet.metrics is not None:
+            report.metrics.add(snippet.metrics)
+    report.metrics.timings["wall"] = time.perf_counter() - start_time
+
     output_json_file = os.path.join(output_dir, "report.json")
     jsondata =  report.to_json(indent=4)
     os.makedirs(os.path.dirname(output_json_file), exist_ok=True)
@@ -213,9 +274,16 @@ if __name__ == "__main__":
     parser.add_argument('--threshold', type=float, help='Similarity Threshold for retrieval')
     parser.add_argument('--examplefile', type=str, help='Specific example file to run on (optional). Only name of example file needed.', required=False)
     parser.add_argument("--model", type=str, help="Which model to use for fixing", default="gpt-3.5", choices=["gpt-3.5", "gpt-4"])
+    parser.add_argument("--concurrency", type=int, help="Number of examples to fix at the same time", default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--rpm", type=int, help="Maximum number of requests per minute to the model", default=DEFAULT_REQUESTS_PER_MINUTE)
+    parser.add_argument("--tpm", type=int, help="Maximum number of tokens per minute sent to and generated by the model", default=DEFAULT_TOKENS_PER_MINUTE)
+    parser.add_argument("--response-cache", type=str, help="record: reuse cached model responses and cache new ones, replay: only use cached responses (no model calls), bypass: always call the model", choices=RESPONSE_CACHE_MODES)
 
     args = parser.parse_args()
     script_dir = os.path.dirname(__file__)
+    set_rate_limits(requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+    if args.response_cache is not None:
+        set_response_cache_mode(args.response_cache)
 
     with open(os.path.join(args.libpath, "library.json"), 'r') as jsonfile:
         libinfo = json.loads(jsonfile.read()) 
@@ -233,4 +301,4 @@ if __name__ == "__main__":
             fix_example(library=library, example_file=args.examplefile, examples_path=os.path.join(library.path, "examples"), requirements_file=os.path.join(library.path, "requirements.txt"), output_dir=output_dir, db_source=args.dbsource, model=args.model, threshold=args.threshold)
         else:
             # fix all examples for this library
-            fix_examples(library=library, output_dir=output_dir, model=args.model, db_source=args.dbsource, threshold=args.threshold)
+            fix_examples(library=library, output_dir=output_dir, model=args.model, db_source=args.dbsource, threshold=args.threshold, concurrency=args.concurrency)
@@ -0,0 +1,117 @@
+"""
+Long-running server that fixes code snippets for short-lived clients (see fix_client.py).
+
+The server loads the embedding index, the tokenizer and the model clients once, then answers
+requests on a Unix socket: one JSON request per connection, answered with one JSON reply.
+Requests are fixed concurrently on the event loop of the server.
+
+Usage: python fix_server.py [--socket <path>]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+from apiexploration.Library import Library
+from upgraider.Database import get_embedding_index
+from upgraider.Model import fix_suggested_code_async, close_http_sessions_async, get_chat_template
+from upgraider.tokenizer import count_tokens
+from upgraider.fix_client import FIX_SOCKET, fix_reply
+
+# largest request line accepted, i.e. the size of the snippet to fix
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+def warm_up():
+    """
+    Do the work that would otherwise delay the first request
+    """
+    get_embedding_index()
+    get_chat_template()
+    count_tokens("warm up")
+
+async def fix_request(request: dict) -> dict:
+    library = None
+    if request.get("library") is not None:
+        library = Library(
+            name=request["library"]["name"],
+            ghurl="",
+            baseversion=request["library"].get("baseversion"),
+            currentversion=request["library"].get("currentversion"),
+        )
+
+    _, _, parsed_response, ref_count = await fix_suggested_code_async(
+        request["code"], model=request.get("model", "gpt-4"), library=library
+    )
+    return fix_reply(parsed_response, ref_count)
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        line = await reader.readline()
+        if not line:
+            # connections without a request only check that the server is running
+            writer.close()
+            return
+
+        reply = await fix_request(json.loads(line))
+    except Exception as e:
+        print(f"ERROR: could not fix request: {e!r}")
+        reply = {"error": f"{type(e).__name__}: {e}"}
+
+    try:
+        writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+        await writer.drain()
+    finally:
+        writer.close()
+
+def remove_stale_socket(socket_path: str):
+    """
+    Remove the socket file left by a server that is not running anymore
+    """
+    if not os.path.exists(socket_path):
+        return
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except ConnectionRefusedError:
+        os.unlink(socket_path)
+        return
+    finally:
+        client.close()
+
+    raise RuntimeError(f"A fix server is already listening on {socket_path}")
+
+async def start_server(socket_path: str, limit: int = MAX_REQUEST_BYTES) -> asyncio.AbstractServer:
+    """
+    Listen on socket_path. Requests longer than limit bytes are answered with an error.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    remove_stale_socket(socket_path)
+    return await asyncio.start_unix_server(handle_client, path=socket_path, limit=limit)
+
+async def serve(socket_path: str):
+    await asyncio.to_thread(warm_up)
+    server = await start_server(socket_path)
+    print(f"Fix server listening on {socket_path}")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await close_http_sessions_async()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve code fixes on a Unix socket, keeping the index and model clients loaded')
+    parser.add_argument('--socket', type=str, help='path of the socket to listen on', default=FIX_SOCKET)
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
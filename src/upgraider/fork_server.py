@@ -0,0 +1,120 @@
+"""
+Long-lived worker that runs code snippets inside the venv of a library.
+
+The worker imports the library once, then waits for requests on stdin (one JSON object per line).
+Each snippet runs in a forked child, so it starts with the library already imported but cannot
+affect the worker or the following snippets. The replies (one JSON object per line) are written to
+the file descriptor given on the command line; the worker and the snippets keep their stdout and stderr.
+
+Like snippet_runner.py, this script is executed by the python of the venv and must only depend
+on the standard library.
+
+Usage: python fork_server.py <cpu seconds> <memory MB> <module to preload> <replies fd>
+"""
+import atexit
+import importlib
+import json
+import os
+import sys
+import time
+import warnings
+
+from snippet_runner import ProblemRecorder, limit_resources, run_snippet
+
+POLL_INTERVAL = 0.005
+
+def preload(module_name: str) -> list:
+    """
+    Import the module, recording instead of printing the warnings raised while importing it,
+    so that each snippet can report them as a cold interpreter would
+    """
+    with warnings.catch_warnings(record=True) as import_warnings:
+        # "always" keeps the warnings out of the registries, so they are not considered already shown
+        warnings.simplefilter("always")
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            print(f"Could not preload {module_name}: {e}", file=sys.stderr)
+
+    return import_warnings
+
+def run_child(request: dict, cpu_seconds: int, memory_mb: int, import_warnings: list):
+    """
+    Body of the forked child: redirect the standard streams, replay the import warnings and run the snippet,
+    recording its problems in the problems file of the request.
+    Never returns.
+    """
+    exit_code = 0
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        stderr = os.open(request["stderr"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.dup2(stderr, 2)
+        os.chdir(request["cwd"])
+        sys.dont_write_bytecode = True
+        limit_resources(cpu_seconds, memory_mb)
+
+        recorder = ProblemRecorder(request["problems"])
+        recorder.record_warnings()
+        for warning in import_warnings:
+            warnings.warn_explicit(warning.message, warning.category, warning.filename, warning.lineno)
+
+        run_snippet(request["file"], recorder)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            exit_code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        sys.excepthook(*sys.exc_info())
+        exit_code = 1
+
+    try:
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(exit_code)
+
+def wait_child(pid: int, timeout: float) -> (int, bool):
+    """
+    Wait for the child to exit and return its exit code, killing it after timeout seconds.
+    The second value tells whether the child timed out.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        if finished != 0:
+            return os.waitstatus_to_exitcode(status), False
+
+        if time.monotonic() > deadline:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+            return None, True
+
+        time.sleep(POLL_INTERVAL)
+
+def serve(cpu_seconds: int, memory_mb: int, module_name: str, replies_fd: int):
+    replies = os.fdopen(replies_fd, 'w')
+
+    import_warnings = preload(module_name)
+    replies.write(json.dumps({"ready": True}) + "\n")
+    replies.flush()
+
+    for line in sys.stdin:
+        request = json.loads(line)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            replies.close()
+            run_child(request, cpu_seconds, memory_mb, import_warnings)
+
+        returncode, timed_out = wait_child(pid, request["timeout"])
+        replies.write(json.dumps({"returncode": returncode, "timed_out": timed_out}) + "\n")
+        replies.flush()
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3], int(sys.argv[4]))
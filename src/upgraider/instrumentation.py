@@ -0,0 +1,51 @@
+"""
+Lightweight timers and counters for the stages of the pipeline.
+
+Code collecting metrics for a unit of work (e.g. fixing one snippet) wraps it in collect_metrics();
+the code it calls records into the current collector with span() and count(), which do nothing when
+no collector is active. The collector is held in a context variable, so concurrent snippets in
+different threads or asyncio tasks each get their own metrics.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from upgraider.Report import Metrics
+
+_current_metrics = contextvars.ContextVar("upgraider_metrics", default=None)
+_lock = threading.Lock()
+
+def current_metrics() -> Metrics:
+    return _current_metrics.get()
+
+@contextmanager
+def collect_metrics():
+    metrics = Metrics()
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+
+def record_time(stage: str, seconds: float):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        with _lock:
+            metrics.timings[stage] = metrics.timings.get(stage, 0.0) + seconds
+
+def count(name: str, value: int = 1):
+    metrics = _current_metrics.get()
+    if metrics is not None and value:
+        with _lock:
+            metrics.counters[name] = metrics.counters.get(name, 0) + value
+
+@contextmanager
+def span(stage: str):
+    """
+    Add the time spent in the block to the stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(stage, time.perf_counter() - start)
@@ -0,0 +1,114 @@
+import argparse
+from sqlalchemy import create_engine, text
+from upgraider.Database import Base, db_path, enable_wal, encode_embedding, decode_embedding, hash_content
+from upgraider.tokenizer import count_tokens, reference_text
+
+def add_missing_columns(connection) -> list[str]:
+    """
+    Create missing tables and add the columns of the current schema that are missing from existing tables.
+    Returns the names of the added columns.
+    """
+    Base.metadata.create_all(connection)
+    added_columns = []
+
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {row[1] for row in connection.execute(text(f"PRAGMA table_info({table.name})"))}
+
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                added_columns.append(f"{table.name}.{column.name}")
+
+    return added_columns
+
+def fill_missing_content_hashes(connection) -> int:
+    """
+    Compute the content hash of the deprecation comments that do not have one yet.
+    Release notes without a hash are re-parsed (but not re-embedded) on the next ingestion.
+    """
+    rows = connection.execute(
+        text("SELECT id, content FROM deprecation_comments WHERE content_hash IS NULL")
+    ).fetchall()
+
+    if rows:
+        connection.execute(
+            text("UPDATE deprecation_comments SET content_hash = :content_hash WHERE id = :id"),
+            [{"id": id, "content_hash": hash_content(content)} for id, content in rows],
+        )
+
+    return len(rows)
+
+def fill_missing_token_counts(connection) -> int:
+    """
+    Count the tokens of the deprecation comments that were ingested before token counts were stored
+    """
+    rows = connection.execute(
+        text("SELECT id, content FROM deprecation_comments WHERE num_tokens IS NULL")
+    ).fetchall()
+
+    if rows:
+        connection.execute(
+            text("UPDATE deprecation_comments SET num_tokens = :num_tokens WHERE id = :id"),
+            [{"id": id, "num_tokens": count_tokens(reference_text(content or ""))} for id, content in rows],
+        )
+
+    return len(rows)
+
+def upgrade_schema(engine):
+    """
+    Bring the schema of the database up to date and fill in the values of the added columns
+    """
+    with engine.begin() as connection:
+        for column in add_missing_columns(connection):
+            print(f"Added column {column}")
+        fill_missing_content_hashes(connection)
+        fill_missing_token_counts(connection)
+
+def migrate_embeddings_to_binary(connection) -> int:
+    """
+    Convert the JSON text embeddings of all deprecation comments into the binary float32 format.
+    Rows whose embedding is the literal "NULL"/"null" text are set to NULL.
+    Returns the number of converted rows.
+    """
+    rows = connection.execute(
+        text("SELECT id, embedding FROM deprecation_comments WHERE typeof(embedding) = 'text'")
+    ).fetchall()
+
+    updates = []
+    for id, embedding in rows:
+        if embedding.strip().lower() == "null":
+            updates.append({"id": id, "embedding": None})
+        else:
+            updates.append({"id": id, "embedding": encode_embedding(decode_embedding(embedding))})
+
+    if updates:
+        connection.execute(
+            text("UPDATE deprecation_comments SET embedding = :embedding WHERE id = :id"),
+            updates,
+        )
+
+    return len(updates)
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate an existing release notes database to the current storage format')
+    parser.add_argument('--db', type=str, help='path of the sqlite database to migrate', default=db_path)
+
+    args = parser.parse_args()
+    engine = create_engine(f"sqlite:///{args.db}", echo=False)
+    enable_wal(engine)
+
+    upgrade_schema(engine)
+
+    with engine.begin() as connection:
+        converted = migrate_embeddings_to_binary(connection)
+    print(f"Converted {converted} embeddings to binary format")
+
+    # reclaim the space freed by the much smaller binary embeddings
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+
+    print("Finished migrating database")
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,99 @@
 
-from Model import get_embedding
+from upgraider.Model import get_embeddings
+from upgraider.tokenizer import count_tokens, reference_text
 from docutils.utils import Reporter
-from docutils.core import publish_file
-from docutils.parsers.rst import roles, nodes
-from bs4 import BeautifulSoup
+from docutils.core import publish_doctree
+from docutils.parsers.rst import roles
+from docutils import nodes
+from sqlalchemy import insert, delete
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple, defaultdict
+import argparse
 import os
-from upgraider.Database import Session, DeprecationComment, LibReleaseNote
+from upgraider.Database import Session, DeprecationComment, LibReleaseNote, encode_embedding, hash_content, engine, enable_wal
+from upgraider.migrate_db import upgrade_schema
 import re
-import json
 
-def parse_html(html_file: str):
+# release_id is None for release notes that are not in the DB yet
+ReleaseNoteSource = namedtuple("ReleaseNoteSource", ["library", "filename", "version", "path", "content_hash", "release_id"])
+
+def _is_deprecation_section(node) -> bool:
+    return any('deprecat' in id.lower() or 'api' in id.lower() for id in node['ids'])
+
+def _has_ancestor(node, condition) -> bool:
+    parent = node.parent
+    while parent is not None:
+        if condition(parent):
+            return True
+        parent = parent.parent
+    return False
+
+def find_deprecation_items(doctree) -> list[str]:
+    """
+    Collect the list items and paragraphs of all sections whose id mentions deprecations or APIs.
+    A paragraph is followed by the text of the next code block among its siblings, if any.
+    Paragraphs inside list items or tables are part of the text of those, and nested matching
+    sections are only visited once, as part of the outermost matching section.
+    """
     deprecation_items = []
 
-    with open(html_file, 'r') as f:
-        html = f.read()
-        soup = BeautifulSoup(html, 'html.parser')
-
-        for section in soup.find_all("div"):
-            section_id = section.get('id')
-            
-            if section_id and ('deprecat' in section_id.lower() or 'api' in section_id.lower()):
-                for list_item in section.find_all("li"):
-                    deprecation_items.append(list_item.text)
-
-                for paragraph in section.find_all("p"):
-                    text = paragraph.text
-                    
-                    next_sibling = paragraph.find_next_sibling("pre")
-                    if next_sibling is not None:
-                        text += "\n" +  next_sibling.text 
-                    
-                    deprecation_items.append(text)
+    # messages of the parser (e.g., unknown directives) are not part of the release note
+    for message in list(doctree.findall(nodes.system_message)):
+        message.parent.remove(message)
+
+    for section in doctree.findall(lambda node: isinstance(node, (nodes.document, nodes.section))):
+        if not _is_deprecation_section(section) or _has_ancestor(section, _is_deprecation_section):
+            continue
+
+        for list_item in section.findall(nodes.list_item):
+            deprecation_items.append(list_item.astext())
+
+        for paragraph in section.findall(nodes.paragraph):
+            if _has_ancestor(paragraph, lambda node: isinstance(node, (nodes.list_item, nodes.entry))):
+                continue
+
+            text = paragraph.astext()
+
+            code_blocks = paragraph.findall(
+                lambda node: isinstance(node, (nodes.literal_block, nodes.doctest_block)),
+                include_self=False, descend=False, siblings=True
+            )
+            next_code_block = next(iter(code_blocks), None)
+            if next_code_block is not None:
+                text += "\n" + next_code_block.astext()
+
+            deprecation_items.append(text)
 
-    
     return deprecation_items
 
-def save_items(dep_items: list[str], session, release_id):
-    for item in dep_items:
-        embedding = json.dumps(get_embedding(item))
-        session.add(DeprecationComment(
-            content=item,
-            lib_release_note=release_id,
-            embedding=embedding
-        ))
-    
+def insert_items(dep_items: list[str], embeddings: list[list[float]], session, release_id, batch_size: int = None):
+    """
+    Insert the deprecation items of a release note with their embeddings. Rows are inserted in bulk and committed
+    once per batch_size rows, or once for the whole release note if batch_size is not set.
+    """
+    rows = [
+        {
+            "content": item,
+            "lib_release_note": release_id,
+            "embedding": encode_embedding(embedding),
+            "content_hash": hash_content(item),
+            "num_tokens": count_tokens(reference_text(item)),
+        }
+        for item, embedding in zip(dep_items, embeddings)
+    ]
+
+    if not rows:
+        session.commit() # still commit the release note itself
+        return
+
+    batch_size = batch_size or len(rows)
+    for start in range(0, len(rows), batch_size):
+        session.execute(insert(DeprecationComment), rows[start:start + batch_size])
         session.commit()
 
+def save_items(dep_items: list[str], session, release_id, batch_size: int = None):
+    insert_items(dep_items, get_embeddings(dep_items), session, release_id, batch_size)
+
 def get_version_from_filename(filename: str):
     result = re.search(r"(?P<major> 0|[1-9]\d*)\.(?P<minor>0|[1-9]\d*)\.(?P<patch>0|[1-9]\d*)?(?:-((?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?", filename)
     if result is not None:
@@ -58,8 +106,7 @@ def get_version_from_filename(filename: str):
     
     return None
 
-def main():
-    script_dir = os.path.dirname(__file__)
+def register_roles():
     roles.register_generic_role('issue', nodes.emphasis)
     roles.register_generic_role('ref', nodes.emphasis)
     roles.register_generic_role('meth', nodes.emphasis)
@@ -67,59 +114,146 @@ def main():
     roles.register_generic_role('func', nodes.emphasis)
     roles.register_generic_role('attr', nodes.emphasis)
 
-    libraries_folder = os.path.join(script_dir, "../../libraries")
+def extract_items(source_path: str) -> list[str]:
+    """
+    Parse the release note into a doctree in memory and return the deprecation items it contains.
+    Nothing is written to disk. Runs in the worker processes of the ingestion pipeline.
+    """
+    with open(source_path, 'r') as f:
+        source = f.read()
+
+    doctree = publish_doctree(source, source_path=source_path, settings_overrides={'report_level':Reporter.SEVERE_LEVEL})
+    return find_deprecation_items(doctree)
+
+def find_changed_release_notes(session, libraries_folder: str) -> list[ReleaseNoteSource]:
+    """
+    Find the release notes that are not in the DB yet or whose content changed since they were ingested
+    """
+    changed_notes = []
+
     for lib_dir in os.listdir(libraries_folder):
         if lib_dir.startswith("."):
             continue
 
-        print(f"Populating DB with release note data for {lib_dir}...")
+        print(f"Looking for new or changed release notes for {lib_dir}...")
+        notes_path = os.path.join(libraries_folder, lib_dir, "releasenotes")
 
-        session = Session()
-  
-        lib_path = os.path.join(script_dir, f"../../libraries/{lib_dir}")
-        
-        for note in os.listdir(os.path.join(lib_path, "releasenotes")):
-            version = get_version_from_filename(note)
-            print(f"Processing release note {note} for version {version}...")
+        for note in os.listdir(notes_path):
             if note.startswith(".") or not note.endswith(".rst"):
                 continue
 
+            note_path = os.path.join(notes_path, note)
+            with open(note_path, 'rb') as f:
+                content_hash = hash_content(f.read())
+
             lib_release = session.query(LibReleaseNote).filter(LibReleaseNote.library == lib_dir).filter(LibReleaseNote.filename == note).first()
 
-            if lib_release is not None:
-                continue # Release note already exists in DB
+            if lib_release is not None and lib_release.content_hash == content_hash:
+                continue # Release note already exists in DB and did not change
 
-            lib_release = LibReleaseNote(
+            changed_notes.append(ReleaseNoteSource(
                 library=lib_dir,
                 filename=note,
-                version=version
-            )
+                version=get_version_from_filename(note),
+                path=note_path,
+                content_hash=content_hash,
+                release_id=lib_release.id if lib_release is not None else None
+            ))
 
-            session.add(lib_release)
-            session.commit()
+    return changed_notes
 
-            release_id = lib_release.id
+def get_existing_items(session, release_id) -> dict[str, list[int]]:
+    """
+    Return the content hash -> ids of the deprecation comments already stored for a release note
+    """
+    existing_items = defaultdict(list)
 
-            base_name = os.path.splitext(note)[0]
-            output_html_file = os.path.join(lib_path, "releasenotes", f"{base_name}.html")
+    if release_id is not None:
+        rows = session.query(DeprecationComment.id, DeprecationComment.content_hash) \
+            .filter(DeprecationComment.lib_release_note == release_id) \
+            .order_by(DeprecationComment.id)
 
-            source_path = os.path.join(lib_path, "releasenotes", note)
-            
-            publish_file(source_path=source_path, writer_name='html', destination_path=output_html_file, settings_overrides={'report_level':Reporter.SEVERE_LEVEL})
-            deprecated_items = parse_html(output_html_file)
-            
+        for id, content_hash in rows:
+            existing_items[content_hash].append(id)
 
-            print(f"Found {len(deprecated_items)} deprecated items for {note}")
-            save_items(deprecated_items, session=session, release_id=release_id)
-            os.remove(output_html_file)
-            print("Finished embedding and saving items")
-        
-        session.commit()
-        session.close()
+    return existing_items
 
+def save_release_note(note: ReleaseNoteSource, dep_items: list[str], embeddings: list[list[float]], stale_ids: list[int], session, batch_size: int = None):
+    """
+    Store a new or changed release note: dep_items (with their embeddings) are the items that are not
+    in the DB yet, and stale_ids are the ids of the stored items that are no longer in the release note.
+    """
+    if note.release_id is None:
+        lib_release = LibReleaseNote(library=note.library, filename=note.filename)
+        session.add(lib_release)
+    else:
+        lib_release = session.get(LibReleaseNote, note.release_id)
+
+    lib_release.version = note.version
+    lib_release.content_hash = note.content_hash
+
+    if stale_ids:
+        session.execute(delete(DeprecationComment).where(DeprecationComment.id.in_(stale_ids)))
+
+    # the release note and its items are committed together by insert_items
+    session.flush()
+
+    insert_items(dep_items, embeddings, session=session, release_id=lib_release.id, batch_size=batch_size)
+
+def main():
+    parser = argparse.ArgumentParser(description='Populate the DB with the deprecation items of all available release notes')
+    parser.add_argument('--batch-size', type=int, help='number of rows to insert per transaction (default: one transaction per release note)', default=None)
+    parser.add_argument('--workers', type=int, help='number of processes used to parse release notes', default=os.cpu_count())
+    parser.add_argument('--embedding-workers', type=int, help='maximum number of concurrent embedding requests', default=4)
+
+    args = parser.parse_args()
+    script_dir = os.path.dirname(__file__)
+    register_roles()
+
+    libraries_folder = os.path.join(script_dir, "../../libraries")
+    enable_wal(engine)
+    upgrade_schema(engine)
+
+    session = Session()
+    changed_notes = find_changed_release_notes(session, libraries_folder)
+    print(f"Populating DB with {len(changed_notes)} new or changed release notes...")
+
+    # Pipeline: release notes are parsed in a process pool, the extracted items are embedded
+    # by a bounded thread pool, and this thread is the single writer to the DB.
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=register_roles) as parsers, \
+            ThreadPoolExecutor(max_workers=args.embedding_workers) as embedders:
+
+        pending = {parsers.submit(extract_items, note.path): (note, None, None) for note in changed_notes}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                note, new_items, stale_ids = pending.pop(future)
+
+                if new_items is None:
+                    # parsing finished, embed the items that are not stored yet
+                    deprecated_items = list(dict.fromkeys(future.result())) # drop duplicate items
+                    existing_items = get_existing_items(session, note.release_id)
+                    item_hashes = {hash_content(item) for item in deprecated_items}
+
+                    new_items = [item for item in deprecated_items if hash_content(item) not in existing_items]
+                    # keep one stored row per item that is still in the release note
+                    stale_ids = [
+                        id
+                        for content_hash, ids in existing_items.items()
+                        for id in (ids if content_hash not in item_hashes else ids[1:])
+                    ]
+
+                    print(f"Found {len(deprecated_items)} deprecated items for {note.library} {note.filename} (version {note.version}), {len(new_items)} new and {len(stale_ids)} removed")
+                    pending[embedders.submit(get_embeddings, new_items)] = (note, new_items, stale_ids)
+                else:
+                    # embedding finished, save the release note
+                    save_release_note(note, new_items, future.result(), stale_ids, session=session, batch_size=args.batch_size)
+                    print(f"Finished embedding and saving items for {note.library} {note.filename}")
+
+    session.close()
 
-    
-    
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
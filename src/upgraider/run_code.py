@@ -1,69 +1,270 @@
 import subprocess
+import tempfile
+import hashlib
+import dataclasses
 import os
 import re
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
 from Report import RunResult, RunProblem, ProblemType
 from apiexploration.Library import Library
+from upgraider.venv_pool import VenvBuildError, get_venv, venv_python, venv_python_version, hash_requirements
+from upgraider.DiskCache import DiskCache
+from upgraider.instrumentation import span, count
+from upgraider.WorkerPool import get_worker_pool, snippet_env
 
 from dotenv import load_dotenv
 
 load_dotenv()
 script_dir = os.path.dirname(__file__)
 
-def find_attribute_error(error_msg: str):
-    attribute_err = re.search(r"AttributeError: (.*) object has no attribute (.*)\n",error_msg)
-    if attribute_err is not None:
-        return RunProblem(type=ProblemType.ERROR, name="AttributeError", element_name=attribute_err.group(2), target_obj=attribute_err.group(1))
+# limits of each snippet run (0 disables the cpu or memory limit)
+RUN_TIMEOUT = int(os.environ.get("UPGRAIDER_RUN_TIMEOUT", 300)) # seconds of wall clock time
+RUN_CPU_SECONDS = int(os.environ.get("UPGRAIDER_RUN_CPU_SECONDS", 120))
+# address space, not resident memory: numeric libraries reserve far more than they use, so there is no limit by default
+RUN_MEMORY_MB = int(os.environ.get("UPGRAIDER_RUN_MEMORY_MB", 0))
+# warm interpreters per venv that already imported the library; 0 starts a new interpreter for every snippet
+WARM_WORKERS = int(os.environ.get("UPGRAIDER_WARM_WORKERS", os.cpu_count()))
 
-    attribute_err = re.search(r"AttributeError: module (.*) has no attribute (.*)\n", error_msg)
-    if attribute_err is not None:
-        return RunProblem(type=ProblemType.ERROR, name="AttributeError", element_name=attribute_err.group(2), target_obj=attribute_err.group(1))
+# results are cached on disk, keyed on the code and on what it runs with, so unchanged snippets only run once
+RUN_CACHE_ENABLED = os.environ.get("UPGRAIDER_RUN_CACHE", "1") == "1"
+RUN_CACHE_DIR = os.environ.get("UPGRAIDER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "upgraider"))
+RUN_CACHE_MAX_ENTRIES = int(os.environ.get("UPGRAIDER_RUN_CACHE_MAX_ENTRIES", 100_000))
+# bump when the way snippets are run or results are recorded changes, so older results are not reused
+RUN_CACHE_VERSION = 2
+_run_cache = None
 
-def find_type_error(error_msg: str):
-    typeerror = re.search(r"TypeError: (.*) got an unexpected keyword argument (.*)\n", error_msg)
-    if typeerror is not None:
-        return RunProblem(type=ProblemType.ERROR, name="TypeError", element_name=typeerror.group(2), target_obj=typeerror.group(1))
+# a warning is a deprecation if its message says so, whatever its category
+DEPRECATION_MESSAGE = re.compile(r"(.*) (?:is|has been) deprecated")
+
+def to_run_problem(record: dict) -> RunProblem:
+    """
+    Turn a problem record written by snippet_runner.py into a RunProblem.
+    Returns None for warnings whose message does not say that something is or has been deprecated.
+    """
+    if record["kind"] == "warning":
+        deprecated = DEPRECATION_MESSAGE.search(record["message"])
+        if deprecated is None:
+            return None
+
+        return RunProblem(
+            type=ProblemType.DEPRECATION_WARNING,
+            name=record["category"].removesuffix("Warning"),
+            element_name=deprecated.group(1),
+            message=record["message"],
+            filename=record["filename"],
+            lineno=record["lineno"]
+        )
+
+    return RunProblem(
+        type=ProblemType.ERROR,
+        name=record["category"],
+        element_name=record.get("element_name"),
+        target_obj=record.get("target_obj"),
+        message=record["message"],
+        filename=record["filename"],
+        lineno=record["lineno"]
+    )
+
+def read_problems(problems_file: str) -> list[RunProblem]:
+    problems = []
+    if not os.path.exists(problems_file):
+        return problems
+
+    with open(problems_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last record of a killed run can be incomplete
+                continue
+            problem = to_run_problem(record)
+            if problem is not None:
+                problems.append(problem)
+
+    return problems
+
+def run_cold(python: str, file: str, work_dir: str, problems_file: str) -> (int, str, bool):
+    """
+    Run the snippet in a new interpreter. Return its exit code, its stderr and whether it timed out.
+    """
+    command = [python, os.path.join(script_dir, "snippet_runner.py"), str(RUN_CPU_SECONDS), str(RUN_MEMORY_MB), problems_file, os.path.abspath(file)]
+    try:
+        result = subprocess.run(
+            command,
+            stderr=subprocess.PIPE,
+            cwd=work_dir,
+            env=snippet_env(),
+            timeout=RUN_TIMEOUT
+        )
+        return result.returncode, result.stderr.decode('utf-8'), False
+    except subprocess.TimeoutExpired as e:
+        return None, (e.stderr or b"").decode('utf-8'), True
+
+def run_warm(python: str, module_name: str, file: str, work_dir: str, problems_file: str) -> (int, str, bool):
+    """
+    Run the snippet in a child forked from a warm worker that already imported the library.
+    Return its exit code, its stderr and whether it timed out.
+    """
+    pool = get_worker_pool(python, module_name, WARM_WORKERS, RUN_CPU_SECONDS, RUN_MEMORY_MB)
+    # the stderr file sits next to the working directory, so the snippet does not see it
+    stderr_file = os.path.join(os.path.dirname(work_dir), "stderr")
+    returncode, timed_out = pool.run(os.path.abspath(file), work_dir, stderr_file, problems_file, RUN_TIMEOUT)
+
+    with open(stderr_file, 'r', encoding='utf-8', errors='replace') as f:
+        return returncode, f.read(), timed_out
+
+def get_run_cache() -> DiskCache:
+    global _run_cache
+
+    if _run_cache is None:
+        _run_cache = DiskCache(os.path.join(RUN_CACHE_DIR, "runs.db"), max_entries=RUN_CACHE_MAX_ENTRIES)
+
+    return _run_cache
+
+def run_cache_key(code: str, library: Library, requirements_file: str, python_version: str) -> str:
+    code_hash = hashlib.sha256(code.encode('utf-8')).hexdigest()
+    # a run killed by the cpu or memory limit must run again once the limit is raised
+    limits = f"cpu{RUN_CPU_SECONDS}:mem{RUN_MEMORY_MB}"
+    return f"v{RUN_CACHE_VERSION}:{library.name}:{library.currentversion}:{hash_requirements(requirements_file)}:{python_version}:{limits}:{code_hash}"
+
+def encode_run_result(run_result: RunResult, file: str) -> bytes:
+    return json.dumps({"file": os.path.abspath(file), "result": dataclasses.asdict(run_result)}, default=lambda e: e.value).encode('utf-8')
+
+def decode_run_result(data: bytes, file: str) -> RunResult:
+    """
+    Rebuild a cached result. The same code may have run from another file, so its path is replaced by the path of file.
+    """
+    entry = json.loads(data)
+    cached_file, file = entry["file"], os.path.abspath(file)
+    result = entry["result"]
+
+    def to_problem(problem: dict) -> RunProblem:
+        if problem["filename"] == cached_file:
+            problem["filename"] = file
+        return RunProblem(**{**problem, "type": ProblemType(problem["type"])})
+
+    return RunResult(
+        problem_free=result["problem_free"],
+        problem=to_problem(result["problem"]) if result["problem"] is not None else None,
+        msg=result["msg"].replace(cached_file, file) if result["msg"] is not None else None,
+        problems=[to_problem(problem) for problem in result["problems"]] if result["problems"] is not None else None
+    )
 
 def run_code(library: Library, file: str, requirements_file: str) -> RunResult:
+    """
+    Run the snippet in the venv of the library version, or return the result of a previous run of the same code
+    with the same library version, requirements and python. If the venv cannot be built, the run is
+    reported as failed instead of stopping the caller.
+    """
+    # the venv with this library version and requirements is only built the first time it is needed
+    try:
+        venv_dir = get_venv(library, requirements_file)
+    except VenvBuildError as e:
+        print(f"Cannot run {file}: {e}")
+        problem = RunProblem(type=ProblemType.ERROR, name="VenvBuildError", element_name=f"{library.name}=={library.currentversion}")
+        return RunResult(problem_free=False, problem=problem, msg=str(e), problems=[problem])
+
+    if RUN_CACHE_ENABLED:
+        with open(file, 'r') as f:
+            cache_key = run_cache_key(f.read(), library, requirements_file, venv_python_version(venv_dir))
+
+        cached_result = get_run_cache().get(cache_key)
+        if cached_result is not None:
+            print(f"Reusing the result of a previous run of {file}")
+            count("run_cache_hits")
+            return decode_run_result(cached_result, file)
+
+    with span("execution"):
+        run_result = execute_code(library, file, venv_dir)
+    count("runs")
+
+    # a timeout depends on the load of the machine, so it is worth running again next time
+    timed_out = run_result.problem is not None and run_result.problem.name == "Timeout"
+    if RUN_CACHE_ENABLED and not timed_out:
+        get_run_cache().put(cache_key, encode_run_result(run_result, file))
+
+    return run_result
+
+def execute_code(library: Library, file: str, venv_dir: str) -> RunResult:
     print(f"Running {file}...")
 
     problem_free = True
     run_result = RunResult(problem_free)
     
-    try:
-        if requirements_file is not None:
-            result = subprocess.run([f"{script_dir}/run_code.sh", file, library.name, library.currentversion, requirements_file], check=True, stderr=subprocess.PIPE)
+    python = venv_python(venv_dir)
+
+    # each run gets its own working directory, so that runs can happen in parallel
+    with tempfile.TemporaryDirectory(prefix="upgraider-run-") as run_dir:
+        work_dir = os.path.join(run_dir, "work")
+        os.mkdir(work_dir)
+        problems_file = os.path.join(run_dir, "problems.jsonl")
+
+        if WARM_WORKERS > 0:
+            try:
+                returncode, error_msg, timed_out = run_warm(python, library.name, file, work_dir, problems_file)
+            except (RuntimeError, OSError) as e:
+                print(f"Warm worker failed ({e}), running {file} in a new interpreter")
+                if os.path.exists(problems_file):
+                    os.remove(problems_file)
+                returncode, error_msg, timed_out = run_cold(python, file, work_dir, problems_file)
         else:
-            result = subprocess.run([f"{script_dir}/run_code.sh", file, library.name, library.currentversion], check=True, stderr=subprocess.PIPE)
-        
-        error_msg = result.stderr.decode('utf-8')
-
-        #usually DeprecationWarning or FutureWarning
-        future_res = re.search(r"(.*\.py):(\d*): (.*)Warning: (.*) (is|has been) deprecated (.*)\n",result.stderr.decode('utf-8'))
-        if future_res is not None:
-            warning = RunProblem(type=ProblemType.DEPRECATION_WARNING, name=future_res.group(3), element_name=future_res.group(4))
-            run_result.problem = warning
-            run_result.problem_free = False
-            run_result.msg = error_msg
-
-    except subprocess.CalledProcessError as e:
-        error_msg = e.stderr.decode('utf-8')
+            returncode, error_msg, timed_out = run_cold(python, file, work_dir, problems_file)
+
+        problems = read_problems(problems_file)
+
+    if timed_out:
+        problems.append(RunProblem(type=ProblemType.ERROR, name="Timeout", element_name=os.path.basename(file)))
+        error_msg += f"\nTimed out after {RUN_TIMEOUT} seconds"
+
+    errors = [problem for problem in problems if problem.type == ProblemType.ERROR]
+    if returncode != 0 or problems:
         run_result.problem_free = False
         run_result.msg = error_msg
-        
-        # look for more specific errors
-        if "AttributeError" in error_msg:
-            run_result.problem = find_attribute_error(error_msg)
-        elif "TypeError" in error_msg:
-            run_result.problem = find_type_error(error_msg)
-
-        
+        run_result.problems = problems
+        # the error that stopped the run matters most, otherwise the first deprecation warning
+        if errors:
+            run_result.problem = errors[-1]
+        elif problems:
+            run_result.problem = problems[0]
+
     return run_result
 
+def run_codes(library: Library, files: list[str], requirements_file: str, max_workers: int = os.cpu_count()) -> list[RunResult]:
+    """
+    Run several snippets of the same library in parallel. Results are in the order of the files.
+    """
+    # build the venv once before the runs start; if that fails, each run reports the error
+    try:
+        get_venv(library, requirements_file)
+    except VenvBuildError:
+        pass
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda file: run_code(library, file, requirements_file), files))
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--file", help="The full path of the python file to run")
+    parser = argparse.ArgumentParser(description='Run code snippets in the venv of a library')
+    parser.add_argument('--libpath', type=str, help='absolute path of target library folder', required=True)
+    parser.add_argument("--workers", type=int, help="Number of snippets to run at the same time", default=os.cpu_count())
+    parser.add_argument("files", nargs="+", help="The python files to run")
 
     args = parser.parse_args()
 
-    print(run_code(f"{script_dir}/../../data/{args.file}")) 
\ No newline at end of file
+    with open(os.path.join(args.libpath, "library.json"), 'r') as jsonfile:
+        libinfo = json.loads(jsonfile.read())
+        library = Library(
+            name=libinfo['name'],
+            ghurl=libinfo['ghurl'],
+            baseversion=libinfo['baseversion'],
+            currentversion=libinfo['currentversion'],
+            path=args.libpath
+        )
+
+    requirements_file = os.path.join(library.path, "requirements.txt")
+    if not os.path.exists(requirements_file):
+        requirements_file = None
+
+    for file, run_result in zip(args.files, run_codes(library, args.files, requirements_file, args.workers)):
+        print(f"{file}: {run_result}")
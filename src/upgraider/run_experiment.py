@@ -1,6 +1,7 @@
 import os
 import logging as log
-from fix_lib_examples import fix_examples
+from fix_lib_examples import fix_examples, DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from upgraider.Model import set_rate_limits, set_response_cache_mode, RESPONSE_CACHE_MODES
 from apiexploration.Library import Library
 from upgraider.Report import DBSource
 import json
@@ -15,8 +16,15 @@ def main():
     parser = argparse.ArgumentParser(description='Run upgraider on all library examples')
     parser.add_argument('--outputDir', type=str, help='directory to write output to', required=True)
     parser.add_argument("--model", type=str, help="Which model to use for fixing", default="gpt-3.5", choices=["gpt-3.5", "gpt-4"])
+    parser.add_argument("--concurrency", type=int, help="Number of examples to fix at the same time", default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--rpm", type=int, help="Maximum number of requests per minute to the model", default=DEFAULT_REQUESTS_PER_MINUTE)
+    parser.add_argument("--tpm", type=int, help="Maximum number of tokens per minute sent to and generated by the model", default=DEFAULT_TOKENS_PER_MINUTE)
+    parser.add_argument("--response-cache", type=str, help="record: reuse cached model responses and cache new ones, replay: only use cached responses (no model calls), bypass: always call the model", choices=RESPONSE_CACHE_MODES)
 
     args = parser.parse_args()
+    set_rate_limits(requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+    if args.response_cache is not None:
+        set_response_cache_mode(args.response_cache)
 
     libraries_folder = os.path.join(script_dir, "../../libraries")
     output_dir = args.outputDir
@@ -42,7 +50,8 @@ def main():
                 output_dir=os.path.join(output_dir, lib_dir, DBSource.modelonly.value),
                 db_source=DBSource.modelonly.value,
                 threshold=threshold,
-                model = model
+                model = model,
+                concurrency=args.concurrency
             )
             
             print(f"Fixing examples for {library.name} with documentation...")
@@ -51,7 +60,8 @@ def main():
                 output_dir=os.path.join(output_dir, lib_dir, DBSource.documentation.value),
                 db_source=DBSource.documentation.value,
                 threshold=threshold,
-                model = model
+                model = model,
+                concurrency=args.concurrency
             )
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""
+Runs a code snippet inside the venv of its library with resource limits.
+
+Warnings shown while the snippet runs and the exception that ends it are written to the problems
+file as they happen, one JSON record per line, in addition to being printed to stderr as usual.
+
+This script is executed by the python of the venv (not the one running upgraider),
+so it must only depend on the standard library.
+
+Usage: python snippet_runner.py <cpu seconds> <memory MB> <problems file> <snippet file>
+"""
+import json
+import os
+import re
+import resource
+import runpy
+import sys
+import traceback
+import warnings
+
+def limit_resources(cpu_seconds: int, memory_mb: int):
+    if cpu_seconds > 0:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+    if memory_mb > 0:
+        memory_bytes = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+def _describe_obj(obj) -> str:
+    if isinstance(obj, type(sys)):
+        return f"'{obj.__name__}'"
+    return f"'{type(obj).__name__}'"
+
+def exception_record(e: BaseException, file: str) -> dict:
+    """
+    Describe the exception, located at the last line of the snippet in its traceback.
+    For attribute errors and unexpected keyword arguments, also name the missing element and its owner.
+    """
+    filename, lineno = None, None
+    for frame in traceback.extract_tb(e.__traceback__):
+        if frame.filename == file:
+            filename, lineno = frame.filename, frame.lineno
+
+    record = {"kind": "exception", "category": type(e).__name__, "message": str(e), "filename": filename, "lineno": lineno}
+
+    if isinstance(e, AttributeError) and getattr(e, "name", None) is not None:
+        record["element_name"] = f"'{e.name}'"
+        record["target_obj"] = _describe_obj(e.obj)
+    elif isinstance(e, TypeError):
+        keyword = re.search(r"(.*) got an unexpected keyword argument (.*)", str(e))
+        if keyword is not None:
+            record["element_name"] = keyword.group(2)
+            record["target_obj"] = keyword.group(1)
+
+    return record
+
+def warning_record(message: Warning, category: type, filename: str, lineno: int) -> dict:
+    return {"kind": "warning", "category": category.__name__, "message": str(message), "filename": filename, "lineno": lineno}
+
+class ProblemRecorder:
+    """
+    Appends problem records to the problems file, flushing each one so that they survive a crash or a kill
+    """
+
+    def __init__(self, problems_file: str):
+        self.problems = open(problems_file, 'a') if problems_file else None
+
+    def record(self, record: dict):
+        if self.problems is not None:
+            self.problems.write(json.dumps(record) + "\n")
+            self.problems.flush()
+
+    def record_warnings(self):
+        """
+        Make warnings.showwarning record every warning it shows. The filters still decide which warnings
+        are shown, so exactly the warnings that appear on stderr are recorded.
+        """
+        show = warnings.showwarning
+
+        def show_and_record(message, category, filename, lineno, file=None, line=None):
+            self.record(warning_record(message, category, filename, lineno))
+            show(message, category, filename, lineno, file, line)
+
+        warnings.showwarning = show_and_record
+
+def run_snippet(file: str, recorder: ProblemRecorder):
+    # behave like `python <file>`: the snippet is __main__ and its folder is first on the path
+    sys.argv = [file]
+    sys.path[0] = os.path.dirname(file)
+    try:
+        runpy.run_path(file, run_name="__main__")
+    except SystemExit:
+        raise
+    except BaseException as e:
+        recorder.record(exception_record(e, file))
+        raise
+
+if __name__ == "__main__":
+    cpu_seconds, memory_mb, problems_file, file = int(sys.argv[1]), int(sys.argv[2]), sys.argv[3], sys.argv[4]
+    limit_resources(cpu_seconds, memory_mb)
+    recorder = ProblemRecorder(problems_file)
+    recorder.record_warnings()
+    run_snippet(file, recorder)
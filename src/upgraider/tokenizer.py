@@ -0,0 +1,28 @@
+import threading
+
+ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
+
+# tiktoken is only imported when the tokenizer is first needed, so that importing this module stays fast
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    """
+    The cl100k_base tokenizer, loaded on first use
+    """
+    global _encoding
+
+    with _encoding_lock:
+        if _encoding is None:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(ENCODING)
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+def reference_text(content: str) -> str:
+    """
+    The text of a section as it appears in the references of a prompt
+    """
+    return content.replace("\n", " ")
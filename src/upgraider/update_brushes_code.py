@@ -1,4 +1,4 @@
-from upgraider.Model import fix_suggested_code, UpdateStatus 
+from upgraider.fix_client import request_fix, fix_reply
 import sys
 import textwrap
 
@@ -7,19 +7,40 @@ def create_comment(reason: str) -> str:
     lines = ["# " + line for line in lines]
     return "\n".join(lines)
 
+def fix_code(code: str) -> dict:
+    """
+    Fix the code with the fix server if one is running, otherwise in this process.
+    If the server cannot be reached or its reply is lost (timeout, crash), the code is fixed in this
+    process instead. If the server reports that fixing failed, the error is raised: the same model
+    call would most likely fail again here.
+    """
+    try:
+        reply = request_fix(code, model="gpt-4")
+    except OSError as e:
+        # stdout is the updated code, so problems go to stderr
+        print(f"WARNING: fix server failed ({e}), fixing the code in this process", file=sys.stderr)
+        reply = None
+
+    if reply is None:
+        # only pay for loading the model, the index and the tokenizer when there is no server
+        from upgraider.Model import fix_suggested_code
+        prompt_text, model_response, parsed_response, ref_count = fix_suggested_code(code, model="gpt-4")
+        reply = fix_reply(parsed_response, ref_count)
+    return reply
+
 def main():
     code = sys.stdin.read()
-    prompt_text, model_response, parsed_response, ref_count= fix_suggested_code(code, model="gpt-4")
+    reply = fix_code(code)
 
     # stdout will be empty if there is no update
-    if (parsed_response.update_status == UpdateStatus.NO_UPDATE):
+    if (reply["update_status"] == "NO_UPDATE"):
         return
     
-    if parsed_response.reason is not None:
+    if reply["reason"] is not None:
         print("# I updated this code for you because:")
-        print(create_comment(parsed_response.reason))
+        print(create_comment(reply["reason"]))
         
-    print(parsed_response.updated_code)
+    print(reply["updated_code"])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import sys
+from contextlib import contextmanager
+from apiexploration.Library import Library
+from benchmark.list_libraries import list_libraries
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Virtual environments are built once per (library, version, requirements) and reused by all runs.
+# They live under $UPGRAIDER_VENV_POOL, or $SCRATCH_VENV/venvs if only the scratch folder is configured.
+POOL_DIR = os.environ.get(
+    "UPGRAIDER_VENV_POOL",
+    os.path.join(os.environ.get("SCRATCH_VENV", os.path.join(os.path.expanduser("~"), ".cache", "upgraider")), "venvs"),
+)
+# every package installed into a venv is also kept here, so that venvs can be rebuilt without network
+WHEELHOUSE = os.environ.get("UPGRAIDER_WHEELHOUSE", os.path.join(POOL_DIR, "wheels"))
+OFFLINE = os.environ.get("UPGRAIDER_OFFLINE", "0") == "1"
+VENV_PYTHON = os.environ.get("UPGRAIDER_VENV_PYTHON", sys.executable)
+
+READY_MARKER = ".upgraider-ready"
+
+# venvs whose build failed in this process, with the error, so that every snippet does not rebuild them again
+_failed_builds = {}
+
+class VenvBuildError(Exception):
+    """
+    The venv of a library version could not be created or its packages could not be installed
+    """
+
+def hash_requirements(requirements_file: str) -> str:
+    if requirements_file is None:
+        return "noreqs"
+
+    with open(requirements_file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+def venv_path(library: Library, requirements_file: str) -> str:
+    return os.path.join(POOL_DIR, f"{library.name}-{library.currentversion}-{hash_requirements(requirements_file)}")
+
+def venv_python(venv_dir: str) -> str:
+    return os.path.join(venv_dir, "bin", "python")
+
+def venv_python_version(venv_dir: str) -> str:
+    """
+    Version of the python the venv was created with, as recorded in its pyvenv.cfg
+    """
+    with open(os.path.join(venv_dir, "pyvenv.cfg"), 'r') as f:
+        for line in f:
+            key, _, value = line.partition("=")
+            if key.strip() in ("version", "version_info"):
+                return value.strip()
+    return None
+
+@contextmanager
+def _build_lock(venv_dir: str):
+    """
+    Exclusive lock on the venv, shared by threads and processes, held while it is checked or built
+    """
+    os.makedirs(POOL_DIR, exist_ok=True)
+    with open(f"{venv_dir}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _set_read_only(path: str, read_only: bool):
+    """
+    Remove (or restore) the write permissions of everything in path, so that snippets cannot modify a venv
+    """
+    write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    for root, dirs, files in os.walk(path):
+        for name in [root] + [os.path.join(root, file) for file in files]:
+            if os.path.islink(name):
+                continue
+            mode = os.stat(name).st_mode
+            os.chmod(name, mode & ~write_bits if read_only else mode | stat.S_IWUSR)
+
+def _pip(venv_dir: str, *args: str):
+    subprocess.run([venv_python(venv_dir), "-m", "pip", "--disable-pip-version-check", *args], check=True)
+
+def build_venv(venv_dir: str, library: Library, requirements_file: str, offline: bool):
+    """
+    Create the venv and install the library version and its requirements. When online, packages are
+    downloaded to the wheelhouse first; offline, they are only installed from the wheelhouse.
+    The finished venv is read-only.
+    """
+    print(f"Building venv for {library.name} {library.currentversion} in {venv_dir}...")
+    if os.path.exists(venv_dir):
+        # leftovers of an interrupted build
+        _set_read_only(venv_dir, False)
+        shutil.rmtree(venv_dir)
+    subprocess.run([VENV_PYTHON, "-m", "venv", venv_dir], check=True)
+
+    packages = [f"{library.name}=={library.currentversion}"]
+    if requirements_file is not None:
+        packages += ["-r", requirements_file]
+
+    os.makedirs(WHEELHOUSE, exist_ok=True)
+    if not offline:
+        _pip(venv_dir, "download", "--dest", WHEELHOUSE, *packages)
+
+    _pip(venv_dir, "install", "--no-index", "--find-links", WHEELHOUSE, *packages)
+
+    open(os.path.join(venv_dir, READY_MARKER), 'w').close()
+    _set_read_only(venv_dir, True)
+
+def get_venv(library: Library, requirements_file: str, offline: bool = None) -> str:
+    """
+    Return the path of the venv for this library version and requirements, building it on first use.
+    If offline is not set, $UPGRAIDER_OFFLINE decides whether packages may be downloaded.
+    Raises VenvBuildError if the venv cannot be built.
+    """
+    venv_dir = venv_path(library, requirements_file)
+
+    # fast path: the venv was built before (possibly by another process)
+    if os.path.exists(os.path.join(venv_dir, READY_MARKER)):
+        return venv_dir
+
+    if venv_dir in _failed_builds:
+        raise VenvBuildError(_failed_builds[venv_dir])
+
+    with _build_lock(venv_dir):
+        if not os.path.exists(os.path.join(venv_dir, READY_MARKER)):
+            try:
+                build_venv(venv_dir, library, requirements_file, offline=OFFLINE if offline is None else offline)
+            except (subprocess.CalledProcessError, OSError) as e:
+                _failed_builds[venv_dir] = f"Could not build venv for {library.name} {library.currentversion}: {e}"
+                raise VenvBuildError(_failed_builds[venv_dir]) from e
+
+    return venv_dir
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the venvs of all libraries ahead of time')
+    parser.add_argument('--offline', action='store_true', help='only install packages from the wheelhouse')
+
+    args = parser.parse_args()
+
+    for library in list_libraries():
+        requirements_file = os.path.join(library.path, "requirements.txt")
+        if not os.path.exists(requirements_file):
+            requirements_file = None
+
+        try:
+            print(f"Venv for {library.name}: {get_venv(library, requirements_file, offline=OFFLINE or args.offline)}")
+        except VenvBuildError as e:
+            print(f"WARNING: {e}")
+
+if __name__ == "__main__":
+    main()
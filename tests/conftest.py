@@ -1,8 +1,72 @@
+import json
 import os
 import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
 
 
 # Insert the root of the project into the path so we can import from
 # the `tests` package.
 root_path = os.path.abspath(os.path.join(__file__, "..", ".."))
 sys.path.insert(0, root_path)
+
+
+class StubServer:
+    """
+    Local HTTP server answering POST requests with the scripted (status, headers) responses, in order.
+    Once the script is exhausted, it answers 200 with a JSON body. Each answer takes delay seconds.
+    """
+
+    def __init__(self, responses: list, delay: float = 0):
+        self.responses = list(responses)
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, like the model endpoints
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stub.requests.append((time.monotonic(), json.loads(body)))
+                with lock:
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                time.sleep(delay)
+                with lock:
+                    stub.active -= 1
+                status, headers = stub.responses.pop(0) if stub.responses else (200, {})
+                payload = json.dumps({"choices": [{"text": "ok"}]}).encode("utf-8")
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/completions"
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def stub_server():
+    servers = []
+    def start(responses, delay=0):
+        servers.append(StubServer(responses, delay))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
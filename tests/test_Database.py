@@ -0,0 +1,147 @@
+import json
+import sqlite3
+import numpy as np
+import upgraider.Database as Database
+from upgraider.Database import encode_embedding, decode_embedding, EMBEDDING_HEADER, DeprecationComment, LibReleaseNote
+from upgraider.Database import version_key, in_release_scope, partition_sections, build_sharded_index, save_snapshot, load_snapshot, Base
+from upgraider.SectionTable import SectionTable
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+def test_embedding_roundtrip():
+    embedding = [0.1, -0.2, 0.3, 0.4]
+    data = encode_embedding(embedding)
+
+    assert len(data) == EMBEDDING_HEADER.size + 4 * len(embedding)
+
+    decoded = decode_embedding(data)
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, embedding)
+
+def test_decode_legacy_json_embedding():
+    embedding = [0.1, -0.2, 0.3]
+
+    decoded = decode_embedding(json.dumps(embedding))
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, embedding)
+
+def test_decode_missing_embedding():
+    assert decode_embedding(None) is None
+    assert decode_embedding("null") is None
+    assert encode_embedding(None) is None
+
+def _release_sections():
+    release_notes = {
+        1: LibReleaseNote(id=1, library="networkx", version="2.8.3"),
+        2: LibReleaseNote(id=2, library="networkx", version="3.0"),
+        3: LibReleaseNote(id=3, library="networkx", version="3.1"),
+        4: LibReleaseNote(id=4, library="pandas", version="2.0.0"),
+    }
+    sections = [
+        DeprecationComment(id=id, lib_release_note=release, content=f"note {id}", embedding=encode_embedding([1.0, float(id)]))
+        for id, release in enumerate([1, 1, 2, 3, 4, 4])
+    ]
+    return sections, release_notes
+
+def test_version_key():
+    assert version_key("v1.22.3") == (1, 22, 3)
+    assert version_key("3.0") == version_key("3.0.0") == (3,)
+    assert version_key("2.8.10") > version_key("2.8.9")
+
+def test_in_release_scope():
+    assert in_release_scope(("networkx", "3.0"), "networkx", "2.8.2", "3.0")
+    assert in_release_scope(("networkx", None), "networkx", "2.8.2", "3.0")
+    assert not in_release_scope(("networkx", "2.8.2"), "networkx", "2.8.2", "3.0")
+    assert not in_release_scope(("networkx", "3.1"), "networkx", "2.8.2", "3.0")
+    assert not in_release_scope(("pandas", "2.0.0"), "networkx", "2.8.2", "3.0")
+
+def test_embedding_index_is_scoped_to_library_versions(monkeypatch, tmp_path):
+    sections, release_notes = _release_sections()
+    monkeypatch.setattr(Database, "get_embedded_doc_sections", lambda: sections)
+    monkeypatch.setattr(Database, "get_release_notes", lambda: release_notes)
+    monkeypatch.setattr(Database, "embedding_index_path", str(tmp_path / "index"))
+    monkeypatch.setattr(Database, "_embedding_index", None)
+
+    assert len(Database.get_embedding_index()) == len(sections)
+
+    index = Database.get_embedding_index("networkx", "2.8.2", "3.0")
+    assert set(index.shards.keys()) == {("networkx", "2.8.3"), ("networkx", "3.0")}
+    assert sorted(id for _, id in index.search([1.0, 1.0])) == [0, 1, 2]
+    assert index.get_section(2) is sections[2]
+
+def _create_database(path: str, sections: list, release_notes: dict):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as session:
+        session.add_all([LibReleaseNote(id=note.id, library=note.library, version=note.version) for note in release_notes.values()])
+        session.add_all([DeprecationComment(id=section.id, lib_release_note=section.lib_release_note, content=section.content) for section in sections])
+        session.commit()
+    engine.dispose()
+
+def test_database_fingerprint_changes_with_items_and_versions(tmp_path):
+    sections, release_notes = _release_sections()
+    _create_database(tmp_path / "a.db", sections, release_notes)
+    _create_database(tmp_path / "b.db", sections[:-1], release_notes)
+    release_notes[3].version = "3.2"
+    _create_database(tmp_path / "c.db", sections, release_notes)
+
+    fingerprints = {Database.database_fingerprint(str(tmp_path / name)) for name in ["a.db", "b.db", "c.db"]}
+    assert len(fingerprints) == 3
+
+def test_snapshot_is_only_used_when_up_to_date(monkeypatch, tmp_path):
+    sections, release_notes = _release_sections()
+    db_file = tmp_path / "releasenotes.db"
+    _create_database(db_file, sections, release_notes)
+    monkeypatch.setattr(Database, "db_path", str(db_file))
+
+    save_snapshot(build_sharded_index(partition_sections(sections, release_notes)), sections, str(tmp_path / "index"))
+
+    index = load_snapshot(str(tmp_path / "index"))
+    assert len(index.shards) == 4
+    assert isinstance(index.sections, SectionTable)
+    assert index.get_section(5).content == "note 5"
+    assert [id for _, id in index.search([1.0, 1.0], k=2)] == [5, 4]
+
+    # without a database, the snapshot is all there is
+    monkeypatch.setattr(Database, "db_path", str(tmp_path / "missing.db"))
+    assert load_snapshot(str(tmp_path / "index")) is not None
+
+    # nor when the database is a git-lfs pointer
+    lfs_pointer = tmp_path / "pointer.db"
+    lfs_pointer.write_text("version https://git-lfs.github.com/spec/v1\noid sha256:0123\nsize 1024\n")
+    monkeypatch.setattr(Database, "db_path", str(lfs_pointer))
+    assert load_snapshot(str(tmp_path / "index")) is not None
+
+    sections.append(DeprecationComment(id=6, lib_release_note=4, content="note 6"))
+    _create_database(tmp_path / "changed.db", sections, release_notes)
+    monkeypatch.setattr(Database, "db_path", str(tmp_path / "changed.db"))
+    assert load_snapshot(str(tmp_path / "index")) is None
+    assert load_snapshot(str(tmp_path / "missing")) is None
+
+def _create_unmigrated_database(path: str, migrated_columns: bool):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE lib_release_notes (id INTEGER PRIMARY KEY, library VARCHAR, version VARCHAR, filename VARCHAR"
+                       + (", content_hash VARCHAR" if migrated_columns else "") + ")")
+    connection.execute("CREATE TABLE deprecation_comments (id INTEGER PRIMARY KEY, lib_release_note INTEGER, content VARCHAR, embedding TEXT"
+                       + (", content_hash VARCHAR, num_tokens INTEGER" if migrated_columns else "") + ")")
+    connection.execute("INSERT INTO lib_release_notes (id, library, version, filename) VALUES (1, 'numpy', '1.24.0', 'notes.rst')")
+    connection.execute("INSERT INTO deprecation_comments (id, lib_release_note, content, embedding) VALUES (1, 1, 'np.float is deprecated', '[1.0, 0.0]')")
+    connection.execute("INSERT INTO deprecation_comments (id, lib_release_note, content, embedding) VALUES (2, 1, 'no embedding', 'NULL')")
+    connection.commit()
+    connection.close()
+
+def test_unmigrated_database_can_be_read(monkeypatch, tmp_path):
+    db_file = str(tmp_path / "baseline.db")
+    _create_unmigrated_database(db_file, migrated_columns=False)
+    engine = create_engine(f"sqlite:///{db_file}")
+    monkeypatch.setattr(Database, "Session", sessionmaker(bind=engine))
+
+    sections = Database.get_embedded_doc_sections()
+    engine.dispose()
+
+    assert [(section.id, section.num_tokens) for section in sections] == [(1, None)]
+    assert np.allclose(Database.load_embeddings(sections)[1], [1.0, 0.0])
+
+    # migrating the schema alone does not change the fingerprint, so snapshots stay valid
+    _create_unmigrated_database(str(tmp_path / "migrated.db"), migrated_columns=True)
+    assert Database.database_fingerprint(db_file) == Database.database_fingerprint(str(tmp_path / "migrated.db"))
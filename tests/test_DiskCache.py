@@ -0,0 +1,83 @@
+import os
+import sqlite3
+from upgraider.DiskCache import DiskCache
+
+def test_put_and_get(tmp_path):
+    cache = DiskCache(os.path.join(tmp_path, "cache.db"))
+
+    assert cache.get("missing") is None
+
+    cache.put("key", b"value")
+    assert cache.get("key") == b"value"
+    assert "key" in cache
+    assert len(cache) == 1
+
+def test_persists_across_instances(tmp_path):
+    path = os.path.join(tmp_path, "cache.db")
+    cache = DiskCache(path)
+    cache.put("key", b"value")
+    cache.close()
+
+    assert DiskCache(path).get("key") == b"value"
+
+def test_evicts_least_recently_used_entry(tmp_path):
+    cache = DiskCache(os.path.join(tmp_path, "cache.db"), max_entries=2, refresh_interval=0)
+
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    cache.get("a") # a is now more recently used than b
+    cache.put("c", b"3")
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
+
+def test_evicts_to_respect_size_limit(tmp_path):
+    cache = DiskCache(os.path.join(tmp_path, "cache.db"), max_bytes=10)
+
+    cache.put("a", b"x" * 4)
+    cache.put("b", b"x" * 4)
+    cache.put("c", b"x" * 4)
+
+    assert cache.total_bytes() <= 10
+    assert cache.get("a") is None
+    assert cache.get("c") == b"x" * 4
+
+def test_reads_only_refresh_access_time_after_interval(tmp_path):
+    cache = DiskCache(os.path.join(tmp_path, "cache.db"), max_entries=2)
+
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    cache.get("a") # read right after being written, so its access time is not refreshed
+    cache.put("c", b"3")
+
+    assert cache.get("a") is None
+    assert cache.get("b") == b"2"
+
+def test_stats_follow_replacements_and_clear(tmp_path):
+    path = os.path.join(tmp_path, "cache.db")
+    cache = DiskCache(path)
+
+    cache.put("a", b"x" * 4)
+    cache.put("b", b"x" * 6)
+    cache.put("a", b"x" * 10)
+    assert (len(cache), cache.total_bytes()) == (2, 16)
+
+    cache.close()
+    cache = DiskCache(path)
+    assert (len(cache), cache.total_bytes()) == (2, 16)
+
+    cache.clear()
+    assert (len(cache), cache.total_bytes()) == (0, 0)
+
+def test_stats_of_caches_created_without_them(tmp_path):
+    path = os.path.join(tmp_path, "cache.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access INTEGER)")
+    connection.execute("INSERT INTO cache VALUES ('a', x'0102', 2, 0)")
+    connection.commit()
+    connection.close()
+
+    cache = DiskCache(path)
+    assert (len(cache), cache.total_bytes()) == (1, 2)
@@ -0,0 +1,124 @@
+import numpy as np
+from upgraider.EmbeddingIndex import EmbeddingIndex, IVFIndex, ShardedIndex
+
+def _random_embeddings(num_sections: int, dim: int = 16, seed: int = 0) -> dict[int, list[float]]:
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(num_sections, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return {section_id: vector.tolist() for section_id, vector in zip(range(100, 100 + num_sections), vectors)}
+
+def _brute_force(embeddings: dict[int, list[float]], query: list[float]) -> list[(float, int)]:
+    return sorted(
+        [(float(np.dot(query, embedding)), section_id) for section_id, embedding in embeddings.items()],
+        reverse=True,
+    )
+
+def test_search_matches_brute_force_order():
+    embeddings = _random_embeddings(200)
+    query = embeddings[150]
+    index = EmbeddingIndex.from_embeddings(embeddings)
+
+    results = index.search(query)
+    expected = _brute_force(embeddings, query)
+
+    assert [section_id for _, section_id in results] == [section_id for _, section_id in expected]
+    assert results[0][1] == 150
+    assert np.allclose([sim for sim, _ in results], [sim for sim, _ in expected], atol=1e-5)
+
+def test_search_top_k():
+    embeddings = _random_embeddings(200)
+    query = embeddings[120]
+    index = EmbeddingIndex.from_embeddings(embeddings)
+
+    results = index.search(query, k=5)
+    expected = _brute_force(embeddings, query)[:5]
+
+    assert [section_id for _, section_id in results] == [section_id for _, section_id in expected]
+
+def test_search_threshold():
+    embeddings = _random_embeddings(200)
+    query = embeddings[100]
+    index = EmbeddingIndex.from_embeddings(embeddings)
+
+    results = index.search(query, threshold=0.3)
+
+    expected = [section_id for similarity, section_id in _brute_force(embeddings, query) if similarity > 0.3]
+
+    assert len(results) > 0
+    assert [section_id for _, section_id in results] == expected
+
+def test_empty_index():
+    index = EmbeddingIndex.from_embeddings({})
+
+    assert len(index) == 0
+    assert index.search([0.1, 0.2]) == []
+
+def test_save_and_load_memory_maps_the_index(tmp_path):
+    embeddings = _random_embeddings(200)
+    index = EmbeddingIndex.from_embeddings(embeddings)
+    index.save(str(tmp_path / "index"))
+
+    loaded = EmbeddingIndex.load(str(tmp_path / "index"))
+
+    assert type(loaded) is EmbeddingIndex
+    assert isinstance(loaded.matrix.base, np.memmap)
+    assert loaded.search(embeddings[130], k=10) == index.search(embeddings[130], k=10)
+
+def test_ivf_index_probing_all_lists_matches_exact_search():
+    embeddings = _random_embeddings(300)
+    index = EmbeddingIndex.from_embeddings(embeddings)
+    ivf_index = IVFIndex.build(index, num_lists=10, nprobe=10)
+
+    for query_id in [100, 250, 399]:
+        query = embeddings[query_id]
+        for k, threshold in [(15, None), (None, 0.3)]:
+            results = ivf_index.search(query, k=k, threshold=threshold)
+            expected = index.search(query, k=k, threshold=threshold)
+
+            assert [section_id for _, section_id in results] == [section_id for _, section_id in expected]
+            assert np.allclose([sim for sim, _ in results], [sim for sim, _ in expected], atol=1e-5)
+
+def test_ivf_index_only_scans_probed_lists():
+    embeddings = _random_embeddings(300)
+    ivf_index = IVFIndex.build(EmbeddingIndex.from_embeddings(embeddings), num_lists=10, nprobe=2)
+
+    results = ivf_index.search(embeddings[200])
+
+    assert results[0][1] == 200
+    assert 0 < len(results) < len(embeddings)
+
+def test_ivf_index_save_and_load(tmp_path):
+    embeddings = _random_embeddings(300)
+    ivf_index = IVFIndex.build(EmbeddingIndex.from_embeddings(embeddings), num_lists=10, nprobe=3)
+    ivf_index.save(str(tmp_path / "index"))
+
+    loaded = EmbeddingIndex.load(str(tmp_path / "index"))
+    assert type(loaded) is IVFIndex
+    assert loaded.nprobe == 3
+    assert loaded.search(embeddings[170], k=10) == ivf_index.search(embeddings[170], k=10)
+
+    assert EmbeddingIndex.load(str(tmp_path / "index"), nprobe=10).nprobe == 10
+
+def test_empty_ivf_index():
+    ivf_index = IVFIndex.build(EmbeddingIndex.from_embeddings({}))
+
+    assert len(ivf_index) == 0
+    assert ivf_index.search([0.1, 0.2]) == []
+
+def test_sharded_index_merges_shards_and_scopes_them(tmp_path):
+    embeddings = _random_embeddings(300)
+    index = EmbeddingIndex.from_embeddings(embeddings)
+    shard_embeddings = [{id: embedding for id, embedding in embeddings.items() if id % 3 == shard} for shard in range(3)]
+    sharded_index = ShardedIndex({("lib", str(shard)): EmbeddingIndex.from_embeddings(e) for shard, e in enumerate(shard_embeddings)})
+
+    query = embeddings[120]
+    assert [id for _, id in sharded_index.search(query, k=10)] == [id for _, id in index.search(query, k=10)]
+
+    scoped = sharded_index.scoped(lambda key: key[1] == "0")
+    assert len(scoped) == 100
+    assert all(id % 3 == 0 for _, id in scoped.search(query, threshold=0.1))
+
+    sharded_index.save(str(tmp_path / "index"))
+    loaded = ShardedIndex.load(str(tmp_path / "index"))
+    assert loaded.shards.keys() == sharded_index.shards.keys()
+    assert loaded.search(query, k=10) == sharded_index.search(query, k=10)
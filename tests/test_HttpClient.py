@@ -0,0 +1,79 @@
+import asyncio
+import time
+import pytest
+from upgraider.HttpClient import HttpClient, CircuitBreaker, CircuitOpenError, RetryableError, parse_retry_after
+
+def test_transient_errors_are_retried(stub_server):
+    server = stub_server([(503, {}), (502, {})])
+    client = HttpClient(max_retries=3, backoff_base=0.01)
+
+    assert client.post_json(server.url, {"prompt": "p"}) == {"choices": [{"text": "ok"}]}
+    assert len(server.requests) == 3
+    assert all(body == {"prompt": "p"} for _, body in server.requests)
+
+def test_retry_after_is_honored(stub_server):
+    server = stub_server([(429, {"Retry-After": "0.3"})])
+    client = HttpClient(max_retries=3, backoff_base=0.01)
+
+    client.post_json(server.url, {"prompt": "p"})
+    (first, _), (second, _) = server.requests
+    assert second - first >= 0.3
+
+def test_gives_up_after_max_retries(stub_server):
+    server = stub_server([(500, {})] * 10)
+    client = HttpClient(max_retries=2, backoff_base=0.01)
+
+    with pytest.raises(RetryableError):
+        client.post_json(server.url, {"prompt": "p"})
+    assert len(server.requests) == 3
+
+def test_client_errors_are_not_retried(stub_server):
+    server = stub_server([(400, {})])
+    client = HttpClient(max_retries=3, backoff_base=0.01)
+
+    with pytest.raises(Exception):
+        client.post_json(server.url, {"prompt": "p"})
+    assert len(server.requests) == 1
+
+def test_circuit_opens_after_consecutive_failures(stub_server):
+    server = stub_server([(503, {})] * 10)
+    client = HttpClient(max_retries=10, backoff_base=0.01, circuit_breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.2))
+
+    with pytest.raises(CircuitOpenError):
+        client.post_json(server.url, {"prompt": "p"})
+    assert len(server.requests) == 3
+
+    # fails fast while open, and lets a trial request through once the reset timeout passed
+    with pytest.raises(CircuitOpenError):
+        client.post_json(server.url, {"prompt": "p"})
+    assert len(server.requests) == 3
+
+    server.responses = []
+    time.sleep(0.2)
+    assert client.post_json(server.url, {"prompt": "p"}) == {"choices": [{"text": "ok"}]}
+    assert client.circuit_breaker.failures == 0
+
+def test_parse_retry_after():
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+
+def test_semaphore_is_released_during_backoff(stub_server):
+    server = stub_server([(503, {"Retry-After": "0.3"})])
+    client = HttpClient(max_retries=3, backoff_base=0.01)
+
+    async def post_and_check_semaphore():
+        semaphore = asyncio.Semaphore(1)
+        request = asyncio.create_task(client.post_json_async(server.url, {"prompt": "p"}, semaphore=semaphore))
+        while not server.requests:
+            await asyncio.sleep(0.01)
+        # the first attempt failed and the client is backing off: another request can be sent
+        await asyncio.wait_for(semaphore.acquire(), timeout=0.2)
+        semaphore.release()
+        result = await request
+        await client.close_async()
+        return result
+
+    assert asyncio.run(post_and_check_semaphore()) == {"choices": [{"text": "ok"}]}
+    assert len(server.requests) == 2
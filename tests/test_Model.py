@@ -1,4 +1,15 @@
+import os
+import subprocess
+import sys
+import asyncio
+import pytest
+import numpy as np
+from types import SimpleNamespace
+import upgraider.Model as Model
 from upgraider.Model import UpdateStatus, parse_model_response
+from upgraider.EmbeddingIndex import EmbeddingIndex
+from upgraider.DiskCache import DiskCache
+from upgraider.HttpClient import HttpClient
 
 
 def test_correctly_formatted_response():
@@ -137,3 +148,194 @@ List of reference numbers used:
     result = parse_model_response(response)
     assert result.update_status == UpdateStatus.UPDATE
     assert result.reason == f"- {reason1}\n- {reason2}"
+
+def test_batch_by_token_count():
+    texts = [f"deprecated item {i}" for i in range(10)]
+    max_tokens = 3 * len(Model.get_encoding().encode(texts[0]))
+
+    batches = Model.batch_by_token_count(texts, max_tokens=max_tokens, max_inputs=2)
+
+    assert [text for batch in batches for text in batch] == texts
+    assert all(len(batch) <= 2 for batch in batches)
+    assert all(sum(len(Model.get_encoding().encode(text)) for text in batch) <= max_tokens for batch in batches)
+
+class CountingIndex(EmbeddingIndex):
+    """
+    Records the k of every search and the sections that are fetched
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.searched_k = []
+        self.fetched = []
+
+    def search(self, query_embedding, k=None, threshold=None):
+        self.searched_k.append(k)
+        return super().search(query_embedding, k=k, threshold=threshold)
+
+    def get_section(self, section_id):
+        self.fetched.append(section_id)
+        return super().get_section(section_id)
+
+def test_reference_assembly_only_looks_at_top_candidates(monkeypatch):
+    # once the index has ranked the sections, assembling the references should not depend
+    # on the number of sections in the corpus
+    dim = 16
+    rng = np.random.default_rng(0)
+    query_embedding = rng.normal(size=dim).astype(np.float32)
+    monkeypatch.setattr(Model, "get_embedding", lambda text: query_embedding)
+
+    for num_sections in [1_000, 10_000]:
+        sections = [
+            SimpleNamespace(id=i, content=f"The function number {i} is deprecated and will be removed")
+            for i in range(num_sections)
+        ]
+        index = CountingIndex(
+            np.arange(num_sections),
+            rng.normal(size=(num_sections, dim)),
+            {section.id: section for section in sections},
+        )
+
+        references = Model.get_reference_list("some code", sections, threshold=-1.0, index=index)
+
+        assert len(references) > 0
+        assert index.searched_k == [Model.REFERENCE_CANDIDATES]
+        assert len(index.fetched) <= Model.REFERENCE_CANDIDATES
+
+def test_more_candidates_are_requested_when_needed(monkeypatch):
+    # one or two word sections are skipped, so the index is asked for more, doubling k each time
+    monkeypatch.setattr(Model, "REFERENCE_CANDIDATES", 4)
+    num_sections = 20
+    sections = [SimpleNamespace(id=i, content="deprecated", num_tokens=1) for i in range(num_sections)]
+    index = CountingIndex(np.arange(num_sections), np.ones((num_sections, 2)), {section.id: section for section in sections})
+
+    references = Model.select_references(index, [1.0, 1.0], threshold=0.0, max_tokens=100)
+
+    assert references == []
+    assert index.searched_k == [4, 8, 16, 32]
+    assert sorted(set(index.fetched)) == list(range(num_sections))
+
+def test_response_cache_modes(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model, "_response_cache", DiskCache(str(tmp_path / "responses.db")))
+    monkeypatch.setattr(Model, "_response_cache_mode", "record")
+    calls = []
+    async def send_request():
+        calls.append(1)
+        return f"response {len(calls)}"
+
+    def get_model_response(request):
+        return asyncio.run(Model.get_model_response_async("chat", request, send_request))
+
+    request = {"messages": [{"role": "user", "content": "fix this"}], "temperature": 0.0, "model": "gpt-3.5-turbo"}
+
+    Model.set_response_cache_mode("record")
+    assert get_model_response(request) == "response 1"
+    assert get_model_response(request) == "response 1"
+    assert len(calls) == 1
+
+    Model.set_response_cache_mode("replay")
+    assert get_model_response(request) == "response 1"
+    with pytest.raises(Model.ResponseNotRecorded):
+        get_model_response({**request, "model": "gpt-4"})
+    assert len(calls) == 1
+
+    # bypassing neither reads nor updates the cache
+    Model.set_response_cache_mode("bypass")
+    assert get_model_response(request) == "response 2"
+
+    Model.set_response_cache_mode("record")
+    assert get_model_response(request) == "response 1"
+
+def test_fix_suggested_code_async_bounds_concurrent_requests(stub_server, monkeypatch):
+    server = stub_server([(503, {})], delay=0.05)
+    monkeypatch.setenv("GPT4_ENDPOINT", server.url)
+    monkeypatch.setenv("GPT4_AUTH_HEADERS", "{}")
+    monkeypatch.setattr(Model, "_response_cache_mode", "bypass")
+    monkeypatch.setattr(Model, "MAX_CONCURRENT_REQUESTS", 4)
+    monkeypatch.setattr(Model, "_http_clients", {"gpt-4": HttpClient(backoff_base=0.01)})
+
+    async def fix_all():
+        try:
+            return await asyncio.gather(*[
+                Model.fix_suggested_code_async(f"import lib\nlib.f({i})", db_source="modelonly", model="gpt-4")
+                for i in range(20)
+            ])
+        finally:
+            await Model.close_http_sessions_async()
+
+    results = asyncio.run(fix_all())
+
+    # one request is retried after the 503
+    assert len(server.requests) == 21
+    assert server.max_active == 4
+    assert [model_response for _, model_response, _, _ in results] == ["ok"] * 20
+
+    # the sync API is a wrapper around the same coroutines
+    prompt_text, model_response, _, ref_count = Model.fix_suggested_code("import lib", db_source="modelonly", model="gpt-4")
+    assert model_response == "ok" and ref_count == 0
+
+def test_references_fill_the_token_budget():
+    sections = [SimpleNamespace(id=i, content=f"Function f{i} is deprecated,\nuse g{i} instead", num_tokens=None) for i in range(10)]
+    # the sections are ranked in order of their id
+    index = EmbeddingIndex(
+        np.arange(10),
+        np.array([[1.0 - i / 100, 0.0] for i in range(10)]),
+        {section.id: section for section in sections},
+    )
+    reference_tokens = Model.count_tokens("\n1. ") + Model.count_tokens(Model.reference_text(sections[0].content))
+    max_tokens = 3 * reference_tokens + Model.MIN_TRUNCATED_REFERENCE_TOKENS + Model.count_tokens("\n4. ")
+
+    references = Model.select_references(index, [1.0, 0.0], 0.0, max_tokens)
+
+    assert references[:3] == [f"\n{i + 1}. Function f{i} is deprecated, use g{i} instead" for i in range(3)]
+    assert len(references) == 4
+    assert references[3].startswith("\n4. Function f3") and len(references[3]) < len(references[2])
+    assert sum(Model.count_tokens(reference) for reference in references) <= max_tokens
+
+def test_reference_token_budget_leaves_room_for_code():
+    assert Model.reference_token_budget("import lib", "gpt-3.5") == Model.MAX_REFERENCE_TOKENS
+    assert Model.reference_token_budget("x = 1\n" * 5000, "gpt-3.5") == 0
+
+def test_importing_model_defers_heavy_dependencies():
+    src_path = os.path.join(os.path.dirname(__file__), "..", "src")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([src_path, os.path.join(src_path, "upgraider"), os.environ.get("PYTHONPATH", "")])}
+    heavy_modules = ["openai", "tiktoken", "sqlalchemy", "aiohttp", "requests", "jsonpickle"]
+
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys; loaded = set(sys.modules); import upgraider.Model; print([m for m in {heavy_modules} if m in set(sys.modules) - loaded])"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+
+    assert result.stdout.strip() == "[]"
+
+def test_tokens_are_only_counted_when_not_reported(monkeypatch):
+    from upgraider.instrumentation import collect_metrics
+    counted = []
+    monkeypatch.setattr(Model, "count_tokens", lambda text: counted.append(text) or 5)
+    response = {"usage": {"prompt_tokens": 100, "completion_tokens": 20}}
+
+    Model.count_token_usage({}, "prompt", "completion")
+    assert counted == []
+
+    with collect_metrics() as metrics:
+        Model.count_token_usage(response, "prompt", "completion")
+        Model.count_token_usage({"usage": {"prompt_tokens": 1}}, "prompt", "completion")
+
+    assert counted == ["completion"]
+    assert metrics.counters == {"prompt_tokens": 101, "completion_tokens": 25}
+
+def test_gpt4_responses_are_cached_per_endpoint(monkeypatch):
+    endpoints = []
+    async def get_model_response_async(endpoint, request, send_request):
+        endpoints.append(endpoint)
+        return "Update status: No update"
+    monkeypatch.setattr(Model, "get_model_response_async", get_model_response_async)
+
+    for deployment in ["gpt-4-0314", "gpt-4-0613"]:
+        monkeypatch.setenv("GPT4_ENDPOINT", f"https://example.org/deployments/{deployment}/completions")
+        asyncio.run(Model.fix_suggested_code_completion_async("prompt"))
+
+    assert endpoints == [
+        "gpt-4:https://example.org/deployments/gpt-4-0314/completions",
+        "gpt-4:https://example.org/deployments/gpt-4-0613/completions",
+    ]
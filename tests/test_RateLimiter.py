@@ -0,0 +1,57 @@
+import asyncio
+import time
+from upgraider.RateLimiter import RateLimiter
+
+def test_no_limits_does_not_wait():
+    limiter = RateLimiter()
+
+    start = time.monotonic()
+    for _ in range(100):
+        limiter.acquire(1000)
+
+    assert time.monotonic() - start < 0.1
+
+def test_requests_within_budget_do_not_wait():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+
+    start = time.monotonic()
+    for _ in range(10):
+        limiter.acquire(100)
+
+    assert time.monotonic() - start < 0.1
+
+def test_waits_for_token_budget_to_refill():
+    # 6000 tokens per minute refill at 100 tokens per second
+    limiter = RateLimiter(tokens_per_minute=6000)
+    limiter.acquire(6000)
+
+    start = time.monotonic()
+    limiter.acquire(50)
+    elapsed = time.monotonic() - start
+
+    assert 0.4 < elapsed < 1.5
+
+def test_waits_for_request_budget_to_refill():
+    # 600 requests per minute refill at 10 requests per second
+    limiter = RateLimiter(requests_per_minute=600)
+    for _ in range(600):
+        limiter.acquire()
+
+    start = time.monotonic()
+    limiter.acquire()
+    elapsed = time.monotonic() - start
+
+    assert 0.05 < elapsed < 1.0
+
+def test_async_acquire_waits_for_refill():
+    limiter = RateLimiter(requests_per_minute=600)
+
+    async def acquire_all():
+        for _ in range(601):
+            await limiter.acquire_async()
+
+    start = time.monotonic()
+    asyncio.run(acquire_all())
+
+    # the 601st request waits for one request worth of refill (0.1s)
+    assert 0.05 < time.monotonic() - start < 0.5
@@ -0,0 +1,17 @@
+import numpy as np
+from upgraider.SectionTable import SectionTable, Section
+
+def test_sections_roundtrip_through_memory_mapped_files(tmp_path):
+    sections = [Section(7, "df.append is deprecated, use pd.concat", 9), Section(3, "Ünicode nötes", None), Section(5, "", 0)]
+    SectionTable.from_sections(sections).save(str(tmp_path / "sections"))
+
+    table = SectionTable.load(str(tmp_path / "sections"))
+
+    assert isinstance(table.texts, np.memmap)
+    assert len(table) == 3
+    assert list(table) == [3, 5, 7]
+    assert table[7] == sections[0]
+    assert table[3] == sections[1]
+    assert table[5] == sections[2]
+    assert 4 not in table and 5 in table
+    assert table.get(4) is None
@@ -0,0 +1,57 @@
+import sys
+import pytest
+from upgraider.WorkerPool import WorkerPool
+
+@pytest.fixture
+def pool():
+    # workers are started by the first run, so a test can still change the environment they get
+    pool = WorkerPool(sys.executable, "json", max_workers=1, cpu_seconds=0, memory_mb=0)
+    yield pool
+    pool.close()
+
+def run(pool: WorkerPool, tmp_path, code: str, timeout: float = 30) -> (int, str, bool):
+    snippet = tmp_path / "snippet.py"
+    snippet.write_text(code)
+    stderr_file = tmp_path / "stderr"
+
+    returncode, timed_out = pool.run(str(snippet), str(tmp_path), str(stderr_file), str(tmp_path / "problems.jsonl"), timeout)
+    return returncode, stderr_file.read_text(), timed_out
+
+def test_snippets_run_in_isolated_children(pool, tmp_path):
+    # the preloaded module is shared, but changes made by a snippet are not
+    returncode, _, _ = run(pool, tmp_path, "import sys\nassert 'json' in sys.modules\nimport json\njson.CHANGED = True\n")
+    assert returncode == 0
+
+    returncode, stderr, _ = run(pool, tmp_path, "import json\nprint(json.CHANGED)\n")
+    assert returncode == 1
+    assert "AttributeError: module 'json' has no attribute 'CHANGED'\n" in stderr
+
+def test_warnings_and_exit_codes(pool, tmp_path):
+    returncode, stderr, _ = run(pool, tmp_path, "import warnings\nwarnings.warn('f is deprecated', DeprecationWarning)\n")
+    assert returncode == 0
+    assert "snippet.py:2: DeprecationWarning: f is deprecated\n" in stderr
+    assert '"category": "DeprecationWarning"' in (tmp_path / "problems.jsonl").read_text()
+
+    returncode, _, _ = run(pool, tmp_path, "import sys\nsys.exit(3)\n")
+    assert returncode == 3
+
+def test_timeout_kills_snippet(pool, tmp_path):
+    returncode, _, timed_out = run(pool, tmp_path, "import time\ntime.sleep(30)\n", timeout=0.5)
+    assert timed_out and returncode is None
+
+    # the worker is still usable
+    returncode, _, timed_out = run(pool, tmp_path, "pass\n")
+    assert returncode == 0 and not timed_out
+
+def test_snippets_use_one_blas_thread(pool, tmp_path, monkeypatch):
+    monkeypatch.delenv("OPENBLAS_NUM_THREADS", raising=False)
+    returncode, _, _ = run(pool, tmp_path, "import os, sys\nsys.exit(int(os.environ['OPENBLAS_NUM_THREADS']))\n")
+    assert returncode == 1
+
+def test_snippet_stdout_is_not_mixed_with_stderr(pool, tmp_path, capfd):
+    # like a snippet run in a new interpreter, the output goes to the stdout of the process running it
+    returncode, stderr, _ = run(pool, tmp_path, "import sys\nprint('to stdout')\nprint('to stderr', file=sys.stderr)\n")
+
+    assert returncode == 0
+    assert stderr == "to stderr\n"
+    assert "to stdout" in capfd.readouterr().out
@@ -1,4 +1,13 @@
+import os
+import json
+import time
+import random
+import upgraider.fix_lib_examples as fix_lib_examples
 from upgraider.fix_lib_examples import _fix_imports
+from upgraider.Report import SnippetReport, ModelResponse, UpdateStatus, FixStatus, RunResult
+from apiexploration.Library import Library
+from upgraider.instrumentation import count
+from upgraider.Model import ResponseNotRecorded
 
 def test_basic_fix_imports():
     old_code = """
@@ -40,3 +49,73 @@ print("hello there")
     fixed_code = _fix_imports(old_code, new_code)
     assert "from modulex import y as z" in fixed_code
     assert "from pandas import Index" in fixed_code
+
+def test_fix_examples_reports_snippets_in_file_order(tmp_path, monkeypatch):
+    examples_path = os.path.join(tmp_path, "lib", "examples")
+    os.makedirs(examples_path)
+    example_files = [f"example{i}.py" for i in range(8)]
+    for example_file in example_files:
+        with open(os.path.join(examples_path, example_file), 'w') as f:
+            f.write("print('hello')\n")
+
+    def fake_fix_example(library, example_file, **kwargs):
+        time.sleep(random.uniform(0, 0.05)) # finish in random order
+        if example_file == "example3.py":
+            raise ResponseNotRecorded("No recorded response from chat for this request")
+        return SnippetReport(
+            original_file=example_file,
+            api=os.path.splitext(example_file)[0],
+            prompt_file=None,
+            original_run=RunResult(problem_free=False),
+            model_response=ModelResponse(update_status=UpdateStatus.NO_UPDATE, references=None, updated_code=None, reason=None),
+            model_reponse_file=None,
+            num_references=0,
+            modified_file=None,
+            modified_run=None,
+            fix_status=FixStatus.NOT_FIXED
+        )
+
+    monkeypatch.setattr(fix_lib_examples, "fix_example", fake_fix_example)
+
+    library = Library(name="lib", ghurl="", baseversion="1.0", currentversion="2.0", path=os.path.join(tmp_path, "lib"))
+    output_dir = os.path.join(tmp_path, "output")
+    fix_lib_examples.fix_examples(library, output_dir=output_dir, db_source="modelonly", model="gpt-3.5", concurrency=4)
+
+    with open(os.path.join(output_dir, "report.json")) as f:
+        report = json.load(f)
+
+    assert list(report["snippets"].keys()) == sorted(example_files)
+    assert report["num_snippets"] == len(example_files)
+    assert report["metrics"]["timings"]["wall"] > 0
+
+    # a snippet that could not be fixed is reported as such, without stopping the others
+    assert report["snippets"]["example3.py"]["error"] == "ResponseNotRecorded: No recorded response from chat for this request"
+    assert report["snippets"]["example3.py"]["fix_status"] == "NOT_FIXED"
+    assert report["snippets"]["example4.py"]["error"] is None
+
+def test_fix_example_reports_metrics_per_stage(tmp_path, monkeypatch):
+    examples_path = os.path.join(tmp_path, "examples")
+    os.makedirs(examples_path)
+    with open(os.path.join(examples_path, "example.py"), 'w') as f:
+        f.write("import lib\nlib.old()\n")
+
+    def fake_run_code(library, file, requirements_file):
+        count("runs")
+        return RunResult(problem_free=file.endswith("_updated.py"))
+
+    def fake_fix_suggested_code(code, **kwargs):
+        count("prompt_tokens", 100)
+        count("completion_tokens", 20)
+        response = ModelResponse(update_status=UpdateStatus.UPDATE, references="1", updated_code="import lib\nlib.new()\n", reason="renamed")
+        return "prompt", "response", response, 1
+
+    monkeypatch.setattr(fix_lib_examples, "run_code", fake_run_code)
+    monkeypatch.setattr(fix_lib_examples, "fix_suggested_code", fake_fix_suggested_code)
+
+    library = Library(name="lib", ghurl="", baseversion="1.0", currentversion="2.0", path=str(tmp_path))
+    snippet = fix_lib_examples.fix_example(library, "example.py", examples_path, None, str(tmp_path / "output"), "modelonly")
+
+    assert snippet.fix_status == FixStatus.FIXED
+    assert snippet.metrics.counters == {"runs": 2, "prompt_tokens": 100, "completion_tokens": 20}
+    assert set(snippet.metrics.timings) == {"total", "run_original", "run_modified"}
+    assert snippet.metrics.timings["total"] >= snippet.metrics.timings["run_original"] + snippet.metrics.timings["run_modified"]
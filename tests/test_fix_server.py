@@ -0,0 +1,148 @@
+import asyncio
+import io
+import socket
+import sys
+import threading
+import pytest
+import upgraider.fix_server as fix_server
+from upgraider.fix_client import request_fix, FixServerError
+from upgraider.Report import ModelResponse, UpdateStatus
+import upgraider.update_brushes_code as update_brushes_code
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    requests = []
+
+    async def fake_fix_suggested_code_async(code, model, library):
+        requests.append((code, model, library))
+        if code == "fail":
+            raise ValueError("no model")
+        await asyncio.sleep(0.01)
+        response = ModelResponse(update_status=UpdateStatus.UPDATE, references="1", updated_code="np.concatenate(a)", reason="np.append is slower")
+        return "prompt", "response", response, 1
+
+    monkeypatch.setattr(fix_server, "fix_suggested_code_async", fake_fix_suggested_code_async)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    socket_path = str(tmp_path / "fix.sock")
+    running_server = asyncio.run_coroutine_threadsafe(fix_server.start_server(socket_path, limit=4096), loop).result()
+    yield socket_path, requests
+
+    loop.call_soon_threadsafe(running_server.close)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+def test_request_fix_from_server(server):
+    socket_path, requests = server
+    library = {"name": "numpy", "baseversion": "1.22.3", "currentversion": "1.24.2"}
+
+    reply = request_fix("np.append(a)", library=library, socket_path=socket_path)
+
+    assert reply == {"update_status": "UPDATE", "references": "1", "updated_code": "np.concatenate(a)", "reason": "np.append is slower", "ref_count": 1}
+    code, model, requested_library = requests[0]
+    assert (code, model) == ("np.append(a)", "gpt-4")
+    assert (requested_library.name, requested_library.baseversion, requested_library.currentversion) == ("numpy", "1.22.3", "1.24.2")
+
+def test_server_answers_concurrent_requests(server):
+    socket_path, requests = server
+    replies = []
+    threads = [threading.Thread(target=lambda: replies.append(request_fix("np.append(a)", socket_path=socket_path))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(replies) == 8 and all(reply["update_status"] == "UPDATE" for reply in replies)
+
+def test_server_errors_are_raised_by_client(server):
+    socket_path, _ = server
+    with pytest.raises(FixServerError, match="no model"):
+        request_fix("fail", socket_path=socket_path)
+
+def test_oversized_requests_get_an_error_reply(server):
+    socket_path, requests = server
+    with pytest.raises(FixServerError, match="limit"):
+        request_fix("x" * 8192, socket_path=socket_path)
+    assert requests == []
+
+@pytest.fixture
+def silent_server(tmp_path):
+    """
+    A socket that accepts connections, reads the request and closes the connection if asked to, but never replies
+    """
+    socket_path = str(tmp_path / "silent.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen()
+    close = threading.Event()
+
+    def accept():
+        connection, _ = listener.accept()
+        connection.makefile('r').readline()
+        close.wait(timeout=5)
+        connection.close()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    yield socket_path, close
+
+    close.set()
+    thread.join()
+    listener.close()
+
+def test_client_times_out_without_reply(silent_server):
+    socket_path, _ = silent_server
+    with pytest.raises(TimeoutError):
+        request_fix("np.append(a)", socket_path=socket_path, timeout=0.1)
+
+def test_empty_reply_is_an_error(silent_server):
+    socket_path, close = silent_server
+    close.set()
+    with pytest.raises(ConnectionError, match="without replying"):
+        request_fix("np.append(a)", socket_path=socket_path)
+
+def test_stale_socket_is_replaced_but_running_server_is_not(server, tmp_path):
+    socket_path, _ = server
+    with pytest.raises(RuntimeError, match="already listening"):
+        fix_server.remove_stale_socket(socket_path)
+
+    stale_path = str(tmp_path / "stale.sock")
+    open(stale_path, 'w').close()
+    assert request_fix("np.append(a)", socket_path=stale_path) is None
+    fix_server.remove_stale_socket(stale_path)
+
+def test_no_server_running(tmp_path):
+    assert request_fix("np.append(a)", socket_path=str(tmp_path / "missing.sock")) is None
+
+def test_brushes_client_keeps_stdin_stdout_contract(server, monkeypatch, capsys):
+    socket_path, _ = server
+    monkeypatch.setattr(update_brushes_code, "request_fix", lambda code, model: request_fix(code, model, socket_path=socket_path))
+    monkeypatch.setattr(sys, "stdin", io.StringIO("np.append(a)"))
+
+    update_brushes_code.main()
+
+    assert capsys.readouterr().out == "# I updated this code for you because:\n# np.append is slower\nnp.concatenate(a)\n"
+
+def test_brushes_client_fixes_in_process_when_server_fails(monkeypatch):
+    import upgraider.Model as Model
+    def broken_server(code, model):
+        raise ConnectionError("Fix server closed the connection without replying")
+    def fix_suggested_code(code, model):
+        response = ModelResponse(update_status=UpdateStatus.NO_UPDATE, references=None, updated_code=None, reason=None)
+        return "prompt", "response", response, 0
+
+    monkeypatch.setattr(update_brushes_code, "request_fix", broken_server)
+    monkeypatch.setattr(Model, "fix_suggested_code", fix_suggested_code)
+
+    assert update_brushes_code.fix_code("np.append(a)")["update_status"] == "NO_UPDATE"
+
+def test_brushes_client_raises_errors_reported_by_server(server, monkeypatch):
+    socket_path, _ = server
+    monkeypatch.setattr(update_brushes_code, "request_fix", lambda code, model: request_fix(code, model, socket_path=socket_path))
+
+    with pytest.raises(FixServerError):
+        update_brushes_code.fix_code("fail")
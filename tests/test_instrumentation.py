@@ -0,0 +1,41 @@
+import asyncio
+import threading
+import time
+import upgraider.Model as Model
+from upgraider.instrumentation import collect_metrics, span, count, current_metrics
+
+def test_spans_and_counters_add_up():
+    with collect_metrics() as metrics:
+        for _ in range(2):
+            with span("stage"):
+                time.sleep(0.01)
+        count("tokens", 5)
+        count("tokens", 7)
+
+    assert metrics.timings["stage"] >= 0.02
+    assert metrics.counters == {"tokens": 12}
+
+def test_nothing_is_recorded_without_collector():
+    with span("stage"):
+        count("tokens", 5)
+    assert current_metrics() is None
+
+def test_metrics_are_separate_per_thread_and_follow_sync_model_calls():
+    async def model_call(tokens):
+        await asyncio.sleep(0.01)
+        count("prompt_tokens", tokens)
+
+    results = {}
+    def fix_snippet(tokens):
+        with collect_metrics() as metrics:
+            # runs on the background event loop of the sync API
+            Model.run_sync(model_call(tokens))
+        results[tokens] = metrics.counters
+
+    threads = [threading.Thread(target=fix_snippet, args=(tokens,)) for tokens in [1, 2, 3]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {tokens: {"prompt_tokens": tokens} for tokens in [1, 2, 3]}
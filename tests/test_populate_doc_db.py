@@ -0,0 +1,39 @@
+from docutils.core import publish_doctree
+from upgraider.populate_doc_db import find_deprecation_items
+
+RELEASE_NOTE = """
+Release notes
+=============
+
+Enhancements
+------------
+
+- Added ``foo``, which is not a deprecation.
+
+Deprecations
+------------
+
+- ``Index.is_mixed`` is deprecated. Use ``pandas.api.types.infer_dtype`` instead.
+- ``ExcelWriter.save`` is deprecated. Use ``ExcelWriter.close`` instead.
+
+The ``na_sentinel`` argument of ``factorize`` is deprecated. Use ``use_na_sentinel`` instead:
+
+.. code-block:: python
+
+    pd.factorize(values, use_na_sentinel=True)
+
+Other API changes
+^^^^^^^^^^^^^^^^^
+
+- ``infer_datetime_format`` is now strict.
+"""
+
+def test_find_deprecation_items():
+    items = find_deprecation_items(publish_doctree(RELEASE_NOTE))
+
+    assert items == [
+        "Index.is_mixed is deprecated. Use pandas.api.types.infer_dtype instead.",
+        "ExcelWriter.save is deprecated. Use ExcelWriter.close instead.",
+        "infer_datetime_format is now strict.",
+        "The na_sentinel argument of factorize is deprecated. Use use_na_sentinel instead:\npd.factorize(values, use_na_sentinel=True)",
+    ]
@@ -0,0 +1,86 @@
+import subprocess
+import upgraider.run_code as run_code
+import upgraider.venv_pool as venv_pool
+from upgraider.DiskCache import DiskCache
+from apiexploration.Library import Library
+
+def test_results_are_cached_by_code_and_environment(tmp_path, monkeypatch):
+    venv_dir = tmp_path / "venv"
+    venv_dir.mkdir()
+    (venv_dir / "pyvenv.cfg").write_text("home = /usr/bin\nversion = 3.11.7\n")
+
+    executions = []
+    def execute_code(library, file, venv_dir):
+        executions.append(file)
+        problem = run_code.RunProblem(type=run_code.ProblemType.ERROR, name="AttributeError", element_name="'x'", target_obj="'lib'", filename=file, lineno=1)
+        return run_code.RunResult(problem_free=False, problem=problem, msg=f'File "{file}", line 1', problems=[problem])
+
+    monkeypatch.setattr(run_code, "get_venv", lambda library, requirements_file: str(venv_dir))
+    monkeypatch.setattr(run_code, "execute_code", execute_code)
+    monkeypatch.setattr(run_code, "RUN_CACHE_ENABLED", True)
+    monkeypatch.setattr(run_code, "_run_cache", DiskCache(str(tmp_path / "runs.db")))
+
+    original, copy, other = tmp_path / "original.py", tmp_path / "copy.py", tmp_path / "other.py"
+    original.write_text("import lib\nlib.x()\n")
+    copy.write_text("import lib\nlib.x()\n")
+    other.write_text("import lib\nlib.y()\n")
+
+    library = Library(name="lib", ghurl="", baseversion="1.0", currentversion="2.0", path=str(tmp_path))
+    first = run_code.run_code(library, str(original), None)
+    cached = run_code.run_code(library, str(copy), None)
+    assert executions == [str(original)]
+
+    # same code, but the result refers to the file that was asked for
+    assert cached.problem == first.problem
+    assert cached.problem.filename == str(copy)
+    assert cached.msg == f'File "{copy}", line 1'
+
+    run_code.run_code(library, str(other), None)
+    newer = Library(name="lib", ghurl="", baseversion="1.0", currentversion="3.0", path=str(tmp_path))
+    run_code.run_code(newer, str(original), None)
+    assert executions == [str(original), str(other), str(original)]
+
+    # a failure may come from the limits of the run, so the result is not reused once they change
+    monkeypatch.setattr(run_code, "RUN_MEMORY_MB", 8192)
+    run_code.run_code(library, str(original), None)
+    monkeypatch.setattr(run_code, "RUN_CPU_SECONDS", 600)
+    run_code.run_code(library, str(original), None)
+    assert executions == [str(original), str(other), str(original), str(original), str(original)]
+
+def test_venv_build_errors_are_failed_runs(tmp_path, monkeypatch):
+    builds = []
+    def build_venv(venv_dir, library, requirements_file, offline):
+        builds.append(venv_dir)
+        raise subprocess.CalledProcessError(1, ["pip", "install"])
+
+    monkeypatch.setattr(venv_pool, "POOL_DIR", str(tmp_path / "venvs"))
+    monkeypatch.setattr(venv_pool, "build_venv", build_venv)
+    monkeypatch.setattr(venv_pool, "_failed_builds", {})
+    monkeypatch.setattr(run_code, "RUN_CACHE_ENABLED", False)
+
+    snippet = tmp_path / "snippet.py"
+    snippet.write_text("import lib\n")
+    library = Library(name="lib", ghurl="", baseversion="1.0", currentversion="2.0", path=str(tmp_path))
+
+    results = run_code.run_codes(library, [str(snippet), str(snippet)], None, max_workers=1)
+    for result in results:
+        assert not result.problem_free
+        assert result.problem.name == "VenvBuildError"
+        assert "Could not build venv for lib 2.0" in result.msg
+
+    # the failed build is not attempted again for every snippet
+    assert len(builds) == 1
+
+def test_only_warnings_about_deprecations_are_problems():
+    def warning(category, message):
+        return {"kind": "warning", "category": category, "message": message, "filename": "snippet.py", "lineno": 3}
+
+    problem = run_code.to_run_problem(warning("FutureWarning", "The default value of numeric_only is deprecated"))
+    assert problem.type == run_code.ProblemType.DEPRECATION_WARNING
+    assert problem.name == "Future"
+    assert problem.element_name == "The default value of numeric_only"
+
+    # the message decides, not the category
+    assert run_code.to_run_problem(warning("UserWarning", "pandas.Int64Index has been deprecated")).name == "User"
+    assert run_code.to_run_problem(warning("DeprecationWarning", "Please use `gaussian_filter` from the `scipy.ndimage` namespace")) is None
+    assert run_code.to_run_problem(warning("FutureWarning", "The behavior of DataFrame concatenation will change")) is None
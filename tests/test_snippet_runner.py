@@ -0,0 +1,64 @@
+import json
+import subprocess
+import sys
+from upgraider import snippet_runner
+
+def run_snippet(tmp_path, code: str, cpu_seconds: int = 0, memory_mb: int = 0) -> subprocess.CompletedProcess:
+    snippet = tmp_path / "snippet.py"
+    snippet.write_text(code)
+    return subprocess.run(
+        [sys.executable, snippet_runner.__file__, str(cpu_seconds), str(memory_mb), str(tmp_path / "problems.jsonl"), str(snippet)],
+        stderr=subprocess.PIPE,
+        cwd=tmp_path,
+    )
+
+def test_snippet_runs_as_main(tmp_path):
+    (tmp_path / "helper.py").write_text("VALUE = 42\n")
+    result = run_snippet(tmp_path, "import sys, helper\nassert __name__ == '__main__'\nassert sys.argv[0].endswith('snippet.py')\nassert helper.VALUE == 42\n")
+
+    assert result.returncode == 0, result.stderr.decode('utf-8')
+
+def test_snippet_error_is_reported(tmp_path):
+    result = run_snippet(tmp_path, "import os\nos.does_not_exist\n")
+
+    assert result.returncode != 0
+    assert "AttributeError: module 'os' has no attribute 'does_not_exist'\n" in result.stderr.decode('utf-8')
+
+def test_memory_limit(tmp_path):
+    result = run_snippet(tmp_path, "data = bytearray(1024 * 1024 * 1024)\n", memory_mb=256)
+
+    assert result.returncode != 0
+    assert "MemoryError" in result.stderr.decode('utf-8')
+
+def read_records(tmp_path) -> list[dict]:
+    with open(tmp_path / "problems.jsonl") as f:
+        return [json.loads(line) for line in f]
+
+def test_every_warning_and_the_exception_are_recorded(tmp_path):
+    code = (
+        "import warnings, os\n"
+        "warnings.warn('f is deprecated', DeprecationWarning)\n"
+        "warnings.warn('g has been deprecated', FutureWarning)\n"
+        "os.does_not_exist\n"
+    )
+    result = run_snippet(tmp_path, code)
+
+    assert "DeprecationWarning: f is deprecated" in result.stderr.decode('utf-8')
+    snippet = str(tmp_path / "snippet.py")
+    assert read_records(tmp_path) == [
+        {"kind": "warning", "category": "DeprecationWarning", "message": "f is deprecated", "filename": snippet, "lineno": 2},
+        {"kind": "warning", "category": "FutureWarning", "message": "g has been deprecated", "filename": snippet, "lineno": 3},
+        {
+            "kind": "exception", "category": "AttributeError", "message": "module 'os' has no attribute 'does_not_exist'",
+            "filename": snippet, "lineno": 4, "element_name": "'does_not_exist'", "target_obj": "'os'"
+        },
+    ]
+
+def test_unexpected_keyword_is_recorded(tmp_path):
+    run_snippet(tmp_path, "def f(a):\n    pass\nf(a=1, b=2)\n")
+
+    record = read_records(tmp_path)[0]
+    assert record["category"] == "TypeError"
+    assert record["element_name"] == "'b'"
+    assert record["target_obj"] == "f()"
+    assert record["lineno"] == 3